@@ -0,0 +1,36 @@
+'''
+Instrument drivers.
+
+Driver modules are only imported when one of their classes is first used, so
+importing the package stays cheap however many drivers there are:
+
+    from instrumentlibrary import instruments
+    supply = instruments.RP100('ASRL5')
+
+Instruments described by data files in instruments/specs need no driver at all:
+
+    supply = instruments.create('rp100', 'ASRL5')
+'''
+
+import importlib
+
+# class name: driver module
+drivers = {'RP100':'rp100',
+           'Instrument':'instrument_template'}
+
+def __getattr__(name):
+    if name in drivers:
+        value = getattr(importlib.import_module('.' + drivers[name],__name__),name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {:s} has no attribute {:s}'.format(__name__,name))
+
+def __dir__():
+    return sorted(list(globals()) + list(drivers))
+
+def create(name,address=None,simulate=False,**communication_args):
+    '''
+    Create a Device from an instrument spec; see source.instrument_spec.
+    '''
+    from ..source import instrument_spec
+    return instrument_spec.create(name,address,simulate,**communication_args)
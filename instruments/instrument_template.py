@@ -10,12 +10,14 @@ from ..source import device
 
 class Instrument(device.Device):
 
-    def __init__(self, address=''):
+    def __init__(self, address='', simulate=False):
         '''Initializes device based on base method.
 
         args:
 
-            - name: string, device identifier
+            - address: string, device address
+
+            - simulate: bool, run against the simulated protocol instead of hardware
 
         For each new instrument the commuication arguments and commands can be specified below as:
 
@@ -34,7 +36,9 @@ class Instrument(device.Device):
         ######################
         ######################
 
+        self.communication_args = communication_args
         self.communication_args['Address'] = address
+        self.simulate = simulate or self.simulate
         self.name = ''
         self.initialize_device(self.name, communication_args, commands)
 
@@ -6,23 +6,55 @@ Razorbill power supply RP100
 @author: Alex Liebman-Pelaez
 '''
 
+import time
+
 from ..source import device
+from ..source import instrument_spec
+
+def simulated_output(sim, channel):
+    '''
+        output voltage of the simulated supply: it moves from the previous output
+        towards the setpoint at the slew rate.
+    '''
+    start, target, t0 = sim.state.get(('ramp', channel), (0.0, 0.0, 0.0))
+    slew = float(sim.state.get(f'SOUR{channel}:VOLT:SLEW', 10.0))
+    travelled = slew*(time.monotonic() - t0)
+    if travelled >= abs(target - start):
+        return target
+    return start + travelled*(1 if target > start else -1)
+
+def simulated_response(message, sim):
+    '''
+        response table for the simulated RP100, so that ramps behave as on hardware.
+        Everything else falls through to the simulator's default behaviour.
+    '''
+    header, _, argument = message.lstrip(':').partition(' ')
+    if not header.startswith('SOUR'):
+        return None
+    channel = header[4:].split(':')[0]
+    if header.endswith(':VOLT') and argument:
+        sim.state[('ramp', channel)] = (simulated_output(sim, channel), float(argument), time.monotonic())
+    elif header.endswith(':VOLT:NOW?'):
+        return str(simulated_output(sim, channel))
+    return None
 
 class RP100(device.Device):
 
-    def __init__(self, address='ASRL5'):
+    simulation_args = {'Responses':simulated_response}
+
+    def __init__(self, address='ASRL5', simulate=False, temperature='room'):
         '''Initializes device based on base method.
 
         args:
 
-            - name: string, device identifier
+            - address: string, device address
 
-        For each new instrument the commuication arguments and commands can be specified below as:
+            - simulate: bool, run against the simulated protocol instead of hardware
 
-            - communication_args: dictionary, communication protocol specifications
-
-            - commands: dictionary, command strings for communicating with device.
+            - temperature: string, 'room' or '4K', selects the allowed drive range
 
+        The communication arguments, commands and drive limits are defined in
+        instruments/specs/rp100.toml.
 
         Some important constraints for this specific device:
         (1) keep slew rate below 100 V/s
@@ -30,64 +62,126 @@ class RP100(device.Device):
         (3)
         '''
 
-        ######################
-        ## User Input Here ###
-        ######################
-        communication_args = {'Protocol':'Serial_VISA', 'Address':'ASRL5', 'ErrorScheme':'', 'Baud':9600, 'Terminator':'\n'}
-        commands = {'System clear':('*CLS', False),
-         'Reset device':('*RST', False),
-         'Set output relay on or off':('OUTP# <bool>', False),
-         'Query ouput relay':('OUTP#?', False),
-         'Set output voltage':('SOUR#:VOLT <float>', False),
-         'Query output voltage':('SOUR#:VOLT:NOW?', False),
-         'Query output setpoint':('SOUR#:VOLT?', False),
-         'Set voltage slew rate':('SOUR#:VOLT:SLEW <float>', False),
-         'Query voltage slew rate':('SOUR#:VOLT:SLEW?', False),
-         'Measure output voltage':('MEAS#:VOLT?', False),
-         'Measure output currrent':('MEAS#[:CURR?', False),
-         'Get last error':('SYST:ERR?', False),
-         'Get number of errors':('SYST:ERR:COUN?', False)}
-        ######################
-        ######################
-        ######################
-
-        self.communication_args['Address'] = address
-        self.name = 'RP100'
-        self.initialize_device(self.name, communication_args, commands)
+        spec = instrument_spec.registry.get('RP100')
+        self.simulate = simulate or self.simulate
+        self.name = spec.name
+        self.limits = spec.limits
+        self.set_temperature(temperature)
+        self.initialize_spec(spec, address)
 
         ## any other code you want to run to initialize the device.
 
+    def set_temperature(self, temperature):
+        '''
+            select the drive limits for the operating temperature.
+
+            args:
+                - temperature: string, 'room' or '4K'
+        '''
+        voltage_limits = self.limits['Voltage']
+        if temperature not in voltage_limits:
+            raise ValueError(f'Unknown temperature {temperature}, choose from {list(voltage_limits)}.')
+        self.temperature = temperature
+        self.min_voltage, self.max_voltage = voltage_limits[temperature]
+
     def set_voltage(self, channel, level):
         '''
-            sets voltage level of specific channel at a specific level.
-            TODO: limit voltage according to temperature
+            sets voltage level of specific channel at a specific level, within the
+            limits for the current temperature (see set_temperature).
 
             args:
                 - channel: int, 1 or 2
                 - level: float, from -200 to 200
         '''
-        min_voltage = -20
-        max_voltage = 120
+        min_voltage = self.min_voltage
+        max_voltage = self.max_voltage
 
         if min_voltage <= level <= max_voltage:
-            self.write(f'SOUR{channel}:VOLT {level}')
+            self.command('Set output voltage', channel=channel, value=level)
             print(f'\n Voltage on Channel {channel} set to {level} V.')
         else:
             print(f'\n Set Voltage outside the acceptable voltage range ({min_voltage}, {max_voltage}).')
 
+    def ramp_voltage(self, channel, setpoints, slew_rate=None, tolerance=0.01, poll_interval=0.1, timeout=None, callback=None):
+        '''
+            step the output of one channel through a list of setpoints, letting the
+            supply's own slew-rate control do the ramping between them. Each setpoint
+            is written as soon as the output has reached the previous one, in the same
+            message as the SOUR#:VOLT:NOW? poll that starts tracking it, so a point costs
+            a single transaction when the output keeps up. Between polls, the sweep
+            sleeps for the time the slew rate needs to cover the remaining distance.
+
+            All setpoints are checked against the limits for the current temperature
+            before anything is written.
+
+            args:
+                - channel: int, 1 or 2
+                - setpoints: sequence of floats, in V
+                - slew_rate: float, V/s. Set before the sweep if given; otherwise the current setting is used.
+                - tolerance: float, V, how close the output must be to count as having reached a setpoint
+                - poll_interval: float, s, longest wait between polls
+                - timeout: float, s, longest time allowed per setpoint. Defaults to twice the time the slew rate needs, plus 1 s.
+                - callback: callable(index, setpoint, output), called when each setpoint is reached
+
+            return:
+                - outputs: list of floats, output voltage read when each setpoint was reached
+        '''
+        setpoints = [float(level) for level in setpoints]
+        outside = [level for level in setpoints if not self.min_voltage <= level <= self.max_voltage]
+        if outside:
+            raise ValueError(f'Setpoints {outside[:5]} outside the acceptable voltage range ({self.min_voltage}, {self.max_voltage}) at {self.temperature} temperature.')
+
+        if slew_rate is not None:
+            min_slew, max_slew = self.limits['Slew']
+            if not min_slew < slew_rate <= max_slew:
+                raise ValueError(f'Slew rate {slew_rate} outside the acceptable range ({min_slew}, {max_slew}) V/s.')
+            self.set_voltage_slew(channel, slew_rate)
+        else:
+            slew_rate = self.command('Query voltage slew rate', channel=channel)
+        if not slew_rate:
+            raise ValueError(f'Slew rate on channel {channel} is zero, the output would never move.')
+
+        set_template = self.Templates['Set output voltage']
+        now_template = self.Templates['Query output voltage']
+        now_message = self.connection.build(now_template.format(channel))
+
+        outputs = []
+        output = None
+        for index, level in enumerate(setpoints):
+            set_message = set_template.format(channel, level)
+            if self.compound_queries:
+                output = now_template.parse(self.query(self.connection.build(set_message + ';:' + now_template.format(channel))))
+            else:
+                self.write(self.connection.build(set_message))
+                output = now_template.parse(self.query(now_message))
+
+            limit = timeout
+            if limit is None:
+                limit = 2*abs(level - output)/slew_rate + 1.0
+            deadline = time.monotonic() + limit
+            while abs(output - level) > tolerance:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Channel {channel} did not reach {level} V within {limit:.1f} s (output {output} V).')
+                time.sleep(min(abs(level - output)/slew_rate, poll_interval))
+                output = now_template.parse(self.query(now_message))
+
+            outputs.append(output)
+            if callback is not None:
+                callback(index, level, output)
+        return outputs
+
     def set_voltage_slew(self, channel, slew_rate):
         '''
             sets voltage slew rate in V/s of specific channel.
 
             args:
                 - channel: int, 1 or 2
-                - slew: float, from 0 to 10
+                - slew_rate: float, from 0 to 10
         '''
-        min_slew = 0
-        max_slew = 10
+        min_slew, max_slew = self.limits['Slew']
 
         if min_slew <= slew_rate <= max_slew:
-            self.write(f'SOUR{channel}:VOLT:SLEW {slew}')
+            self.command('Set voltage slew rate', channel=channel, value=slew_rate)
             print(f'\n Voltage Slew Rate on Channel {channel} set to {slew_rate} V/s.')
         else:
             print(f'\n Set Voltage Slew Rate outside the acceptable voltage range ({min_slew}, {max_slew}).')
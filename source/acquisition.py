@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Continuous background acquisition into a fixed-size ring buffer.
+
+A worker thread samples a set of device commands at a fixed rate and writes
+timestamped readings into preallocated NumPy arrays. There is a single writer,
+and readers never take a lock. The writer publishes a row by bumping a counter
+after the row is written, and a reader copies the rows it wants and then checks
+that the writer has not wrapped around onto them in the meantime. Live plots and
+feedback loops can therefore take the latest N samples at any time without
+stopping acquisition or touching the bus. Requires numpy.
+'''
+
+import threading
+import time
+
+import numpy as np
+
+class RingBuffer:
+
+    def __init__(self,size,columns):
+        '''
+        Preallocate the buffer.
+
+        args:
+
+            - size: int, number of samples kept
+
+            - columns: list of strings, names of the sampled quantities
+        '''
+        self.size = size
+        self.columns = list(columns)
+        self.times = np.zeros(size,dtype=np.int64)
+        self.values = np.full((size,len(self.columns)),np.nan)
+        self.count = 0
+
+    def append(self,timestamp,values):
+        '''
+        Write one sample. Only one thread may call this.
+
+        args:
+
+            - timestamp: int, epoch nanoseconds
+
+            - values: sequence of floats, one per column
+        '''
+        row = self.count % self.size
+        self.times[row] = timestamp
+        self.values[row] = values
+        self.count += 1
+
+    def latest(self,n=None):
+        '''
+        Copy of the most recent n samples, oldest first, without blocking the writer.
+        At most size - 1 samples are returned: the oldest row may be the one being overwritten.
+
+        args:
+
+            - n: int, number of samples. All available samples if None.
+
+        return:
+
+            - times: int64 array of epoch nanoseconds
+
+            - values: float64 array, one row per sample and one column per quantity
+        '''
+        while True:
+            count = self.count
+            available = min(count,self.size - 1)
+            wanted = available if n is None else min(n,available)
+            rows = np.arange(count - wanted,count) % self.size
+            times = self.times[rows]
+            values = self.values[rows]
+            # the writer fills row self.count % size next; if it reached the rows just
+            # copied, they may be torn and the copy is retried
+            if self.count - (count - wanted) < self.size:
+                return times,values
+
+    def view(self,n=None):
+        '''
+        Read-only views of the most recent n samples, with no copy. The views are only
+        contiguous if the samples do not wrap around the end of the buffer; otherwise
+        None is returned and latest() should be used. The data can change under the
+        views as the writer advances, so they suit plotting rather than analysis.
+
+        return:
+
+            - times, values: array views, or None
+        '''
+        count = self.count
+        available = min(count,self.size)
+        n = available if n is None else min(n,available)
+        end = count % self.size or (self.size if count else 0)
+        if end < n:
+            return None
+        times = self.times[end-n:end]
+        values = self.values[end-n:end]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        return times,values
+
+class Acquisition:
+
+    def __init__(self,device,commands,rate,size=10000,channel=None):
+        '''
+        Set up continuous sampling of a device. Call start() to begin.
+
+        args:
+
+            - device: Device instance
+
+            - commands: list of command names from the device's CommandTable. Each reply is
+            converted with the command's template and stored as a float.
+
+            - rate: float, samples per second
+
+            - size: int, number of samples kept in the ring buffer
+
+            - channel: int, channel substituted into templated commands
+        '''
+        self.device = device
+        self.commands = list(commands)
+        self.period = 1.0/rate
+        self.channel = channel
+        self.buffer = RingBuffer(size,self.commands)
+        self.overruns = 0
+        self.errors = 0
+        self.last_error = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        values = []
+        for command in self.commands:
+            try:
+                values.append(float(self.device.command(command,channel=self.channel)))
+            except Exception as error:
+                self.errors += 1
+                self.last_error = error
+                values.append(np.nan)
+        return values
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self.stopping.is_set():
+            timestamp = time.time_ns()
+            self.buffer.append(timestamp,self.sample())
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                # fell behind: skip the missed slots rather than bursting to catch up
+                self.overruns += 1
+                deadline = time.monotonic()
+            elif self.stopping.wait(delay):
+                break
+
+    def start(self):
+        '''
+        Start the worker thread.
+        '''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run,name='Acquisition {:s}'.format(str(self.device.name)),daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop the worker thread, waiting for the sample in progress to finish.
+        '''
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def latest(self,n=None):
+        '''
+        Copy of the most recent n samples; see RingBuffer.latest.
+        '''
+        return self.buffer.latest(n)
+
+    def view(self,n=None):
+        '''
+        No-copy views of the most recent n samples; see RingBuffer.view.
+        '''
+        return self.buffer.view(n)
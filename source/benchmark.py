@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for transport round trips, status polls and startup costs.
+
+Run as a module from the directory containing the package:
+
+    python -m instrumentlibrary.source.benchmark --output results.json
+    python -m instrumentlibrary.source.benchmark --output new.json --compare results.json
+
+No hardware is needed. RS232 paths run over a pseudo-terminal loopback: a thread
+on the master side answers with the Sim protocol's logic. VISA paths run
+through a stand-in resource registered in visa_module's ResourceManager cache
+under the '@bench' backend. TCP paths run against a local sim_module.SCPIServer.
+All go through the real connection classes.
+
+Each case reports p50/p99 latency, throughput in queries per second and the peak
+memory allocated by a single call (tracemalloc). Import cases also list the heavy
+modules (pyvisa, pyserial, asyncio, numpy) they load. Results are stored as JSON.
+With --compare, any case whose p50 grows by more than --threshold against a previous
+run, or that loads a heavy module it did not load before, is flagged, and the exit
+status is 1.
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import select
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from . import sim_module
+
+def percentile(values,fraction):
+    '''
+    Nearest-rank percentile of a list of numbers.
+    '''
+    ordered = sorted(values)
+    return ordered[max(0,math.ceil(fraction*len(ordered))-1)]
+
+def summarize(times):
+    '''
+    Summarize a list of per-call durations, in seconds.
+
+    return:
+
+        - stats: dictionary with 'n', 'mean_s', 'p50_s', 'p99_s' and 'qps'
+    '''
+    mean = statistics.fmean(times)
+    return {'n':len(times),
+            'mean_s':mean,
+            'p50_s':percentile(times,0.5),
+            'p99_s':percentile(times,0.99),
+            'qps':1.0/mean if mean > 0 else float('inf')}
+
+def measure(function,repeat,warmup=3):
+    '''
+    Time repeated calls of function, then measure its allocations.
+
+    args:
+
+        - function: callable with no arguments
+
+        - repeat: int, number of timed calls
+
+        - warmup: int, untimed calls made first
+
+    return:
+
+        - stats: dictionary, as summarize(), plus 'alloc_bytes_per_call', the median
+        peak of memory allocated during one call
+    '''
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    stats = summarize(times)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(repeat,20)):
+            if hasattr(tracemalloc,'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # before Python 3.9; clearing the traces also resets the peak
+                tracemalloc.clear_traces()
+            base = tracemalloc.get_traced_memory()[0]
+            function()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    stats['alloc_bytes_per_call'] = statistics.median(peaks)
+    return stats
+
+class PtyLoopback:
+
+    def __init__(self,sim_args=None,drop_every=0):
+        '''
+        Serial loopback on a pseudo-terminal. RS232 connections open the slave
+        side like any serial port; a thread on the master side answers each
+        line as the Sim protocol would.
+
+        args:
+
+            - sim_args: dictionary, communication arguments for the Sim that produces replies
+
+            - drop_every: int, if non-zero, every n-th message gets no reply (exercises retries)
+        '''
+        self.master,self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self.sim = sim_module.Sim(dict(sim_args or {},Terminator='\n'))
+        self.drop_every = drop_every
+        self.count = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.serve,daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        buffer = b''
+        while self.running:
+            ready,_,_ = select.select([self.master],[],[],0.05)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self.master,4096)
+            except OSError:
+                return
+            while b'\n' in buffer:
+                line,buffer = buffer.split(b'\n',1)
+                self.count += 1
+                if self.drop_every and self.count % self.drop_every == 0:
+                    continue
+                self.sim.write(line.strip().decode())
+                if self.sim.pending:
+                    os.write(self.master,(self.sim.pending.pop(0) + '\r\n').encode())
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+class BenchResource:
+
+    def __init__(self,address,sim_args):
+        '''
+        Stand-in for a pyvisa resource, answering through the Sim protocol.
+        '''
+        self.resource_name = address
+        self.sim = sim_module.Sim(dict(sim_args,Address=address))
+        self.timeout = 2000
+
+    def query(self,message):
+        self.sim.write(message)
+        return self.read()
+
+    def write(self,message):
+        self.sim.write(message)
+
+    def read(self):
+        return self.sim.receive(self.timeout/1000) + '\n'
+
+    def before_close(self):
+        pass
+
+    def close(self):
+        self.sim.close()
+
+class BenchResourceManager:
+
+    def __init__(self,sim_args=None):
+        '''
+        Stand-in for a pyvisa ResourceManager handing out BenchResources.
+        '''
+        self.sim_args = sim_args or {}
+        self.resources = []
+
+    def open_resource(self,address):
+        resource = BenchResource(address,self.sim_args)
+        self.resources.append(resource)
+        return resource
+
+    def list_opened_resources(self):
+        return [resource for resource in self.resources if resource.sim.is_open]
+
+    def close(self):
+        pass
+
+def install_bench_backend(sim_args=None):
+    '''
+    Register the '@bench' backend with visa_module. Requires pyvisa to be importable.
+    Release it with visa_module.release_resource_manager('@bench').
+    '''
+    from . import visa_module
+    visa_module.register_resource_manager('@bench',BenchResourceManager(sim_args))
+    return visa_module
+
+def status_commands(count):
+    return {'Status {:d}'.format(index):('SOUR{:d}:VOLT?'.format(index),True) for index in range(count)}
+
+def make_device(communication_args,count=8):
+    '''
+    Build a bare Device with count status commands over the given connection.
+    '''
+    from . import device
+
+    class BenchDevice(device.Device):
+
+        def __init__(self):
+            self.initialize_device('Bench',communication_args,status_commands(count))
+
+    return BenchDevice()
+
+def rs232_args(port,**extra):
+    return dict({'Protocol':'RS232','Address':port,'Baud':115200,'StopBits':1,'ByteSize':8,'Timeout':0.5},**extra)
+
+# third-party or slow-to-import modules that a case should only load if it needs them
+heavy_modules = ('pyvisa','pyvisa_py','serial','asyncio','numpy')
+
+def bench_import(repeat):
+    '''
+    Import time of the package's modules, each in a fresh interpreter, and the
+    startup of a short script driving one simulated device. Each case also lists
+    the heavy modules it ended up loading.
+    '''
+    package = __package__.rsplit('.',1)[0]
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join([root] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    cases = {'import ' + module:'import {:s}.{:s}'.format(package,module)
+             for module in ['source.device','source.sim_module','source.serial_module','source.visa_module','source.socket_module']}
+    cases['startup sim device'] = ('from {:s}.source import device;instrument=device.Device();'
+                                   'instrument.initialize_device("bench",{{"Protocol":"Sim"}},{{}})').format(package)
+    results = {}
+    for case,statement in cases.items():
+        code = ('import sys,time;start=time.perf_counter();{:s};print(time.perf_counter()-start);'
+                'print(",".join(name for name in {!r} if name in sys.modules))').format(statement,heavy_modules)
+        times = []
+        for _ in range(max(3,repeat//100)):
+            result = subprocess.run([sys.executable,'-c',code],env=env,capture_output=True,text=True)
+            if result.returncode != 0:
+                results[case] = {'skipped':result.stderr.strip().splitlines()[-1]}
+                break
+            elapsed,loaded = result.stdout.splitlines()[-2:]
+            times.append(float(elapsed))
+        else:
+            results[case] = dict(summarize(times),modules=[name for name in loaded.split(',') if name])
+    return results
+
+def bench_sim(repeat):
+    '''
+    Device paths over the Sim protocol, with no wire costs: the library's own overhead.
+    '''
+    results = {}
+    args = {'Protocol':'Sim','Address':'bench'}
+    results['sim initialize_device'] = measure(lambda: make_device(args),repeat)
+    dev = make_device(args)
+    message = dev.connection.build('SOUR1:VOLT?')
+    results['sim query'] = measure(lambda: dev.query(message),repeat)
+    results['sim get_status'] = measure(dev.get_status,repeat)
+    return results
+
+def bench_rs232(repeat):
+    '''
+    RS232 round trips over a pty loopback, with persistent and per-call ports,
+    the retry path, and a full get_status sweep.
+    '''
+    results = {}
+    loopback = PtyLoopback()
+    try:
+        from . import serial_module
+        for persistent in [True,False]:
+            label = 'persistent' if persistent else 'per-call'
+            connection = serial_module.RS232(rs232_args(loopback.port,Persistent=persistent))
+            message = connection.build('SOUR1:VOLT?')
+            results['rs232 query ' + label] = measure(lambda: connection.query(message),repeat)
+            connection.close()
+        results['rs232 initialize_device'] = measure(lambda: make_device(rs232_args(loopback.port)).close_connection(),max(repeat//10,5))
+        dev = make_device(rs232_args(loopback.port))
+        results['rs232 get_status'] = measure(dev.get_status,max(repeat//10,5))
+        dev.close_connection()
+    finally:
+        loopback.close()
+
+    loopback = PtyLoopback(drop_every=2)
+    try:
+        connection = serial_module.RS232(rs232_args(loopback.port,Timeout=0.05))
+        message = connection.build('SOUR1:VOLT?')
+        results['rs232 query with retry'] = measure(lambda: connection.query(message),max(repeat//20,5),warmup=1)
+        connection.close()
+    finally:
+        loopback.close()
+    return results
+
+def bench_visa(repeat):
+    '''
+    VISA GPIB and Serial paths over the '@bench' stand-in resource.
+    '''
+    results = {}
+    visa_module = install_bench_backend()
+    try:
+        for protocol,address in [('GPIB','GPIB0::1::INSTR'),('Serial_VISA','ASRL1::INSTR')]:
+            args = {'Protocol':protocol,'Address':address,'Backend':'@bench','Terminator':'\n'}
+            cls = visa_module.GPIB if protocol == 'GPIB' else visa_module.Serial
+            connection = cls(args)
+            try:
+                message = connection.build('SOUR1:VOLT?')
+                results['visa {:s} query'.format(protocol)] = measure(lambda: connection.query(message),repeat)
+            finally:
+                connection.close()
+            results['visa {:s} initialize_device'.format(protocol)] = measure(lambda: make_device(args).close_connection(),repeat)
+            dev = make_device(args)
+            try:
+                results['visa {:s} get_status'.format(protocol)] = measure(dev.get_status,repeat)
+            finally:
+                dev.close_connection()
+    finally:
+        visa_module.release_resource_manager('@bench')
+    return results
+
+def bench_tcp(repeat):
+    '''
+    Raw socket SCPI against a local sim_module.SCPIServer: single queries, the same
+    queries pipelined with query_many, and a get_status sweep.
+    '''
+    results = {}
+    with sim_module.SCPIServer() as server:
+        args = {'Protocol':'TCP','Address':server.address,'Timeout':0.5}
+        dev = make_device(args)
+        try:
+            messages = [dev.connection.build('SOUR{:d}:VOLT?'.format(index)) for index in range(8)]
+            results['tcp query'] = measure(lambda: dev.query(messages[0]),repeat)
+            results['tcp 8 queries sequential'] = measure(lambda: [dev.query(message) for message in messages],repeat)
+            results['tcp 8 queries pipelined'] = measure(lambda: dev.query_many(messages),repeat)
+            results['tcp get_status'] = measure(dev.get_status,repeat)
+        finally:
+            dev.close_connection()
+    return results
+
+BENCHMARKS = {'import':bench_import,
+              'sim':bench_sim,
+              'rs232':bench_rs232,
+              'visa':bench_visa,
+              'tcp':bench_tcp}
+
+def run(names=None,repeat=200):
+    '''
+    Run benchmark groups. A group whose transport package is not installed is
+    recorded as skipped rather than failing the run.
+
+    args:
+
+        - names: list of strings, keys of BENCHMARKS. All groups if None.
+
+        - repeat: int, number of timed calls per case
+
+    return:
+
+        - report: dictionary with 'meta' and 'results'
+    '''
+    results = {}
+    for name in names or BENCHMARKS:
+        try:
+            results.update(BENCHMARKS[name](repeat))
+        except ImportError as error:
+            results[name] = {'skipped':str(error)}
+    meta = {'python':platform.python_version(),
+            'platform':platform.platform(),
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat':repeat}
+    return {'meta':meta,'results':results}
+
+def compare(report,baseline,threshold=0.2):
+    '''
+    Flag cases whose p50 latency grew by more than threshold against a baseline report.
+
+    return:
+
+        - regressions: dictionary, case:(baseline p50, new p50)
+    '''
+    regressions = {}
+    for case,stats in report['results'].items():
+        old = baseline['results'].get(case,{})
+        if 'p50_s' in stats and 'p50_s' in old and stats['p50_s'] > (1+threshold)*old['p50_s']:
+            regressions[case] = (old['p50_s'],stats['p50_s'])
+    return regressions
+
+def compare_imports(report,baseline):
+    '''
+    Find cases that load heavy modules they did not load in a baseline report.
+
+    return:
+
+        - regressions: dictionary, case:list of newly loaded modules
+    '''
+    regressions = {}
+    for case,stats in report['results'].items():
+        old = baseline['results'].get(case,{})
+        if 'modules' in stats and 'modules' in old:
+            added = [name for name in stats['modules'] if name not in old['modules']]
+            if added:
+                regressions[case] = added
+    return regressions
+
+def print_report(report):
+    for case,stats in report['results'].items():
+        if 'skipped' in stats:
+            print('| {:s} | skipped: {:s} |'.format(case,stats['skipped']))
+        else:
+            line = '| {:s} | p50 {:.3f} ms | p99 {:.3f} ms | {:.0f} q/s |'.format(case,1e3*stats['p50_s'],1e3*stats['p99_s'],stats['qps'])
+            if 'alloc_bytes_per_call' in stats:
+                line += ' {:.0f} B/call |'.format(stats['alloc_bytes_per_call'])
+            if 'modules' in stats:
+                line += ' loads {:s} |'.format(', '.join(stats['modules']) or 'nothing heavy')
+            print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('groups',nargs='*',help='benchmark groups to run, from {:s} (default: all)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--repeat',type=int,default=200)
+    parser.add_argument('--output',help='write results to this JSON file')
+    parser.add_argument('--compare',help='previous JSON results to check for regressions')
+    parser.add_argument('--threshold',type=float,default=0.2,help='relative p50 growth flagged as a regression')
+    options = parser.parse_args(argv)
+    for group in options.groups:
+        if group not in BENCHMARKS:
+            parser.error('unknown benchmark group {:s}'.format(group))
+
+    report = run(options.groups or None,options.repeat)
+    print_report(report)
+    if options.output:
+        with open(options.output,'w') as file:
+            json.dump(report,file,indent=1)
+
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(report,baseline,options.threshold)
+        for case,(old,new) in regressions.items():
+            print('REGRESSION {:s}: p50 {:.3f} ms -> {:.3f} ms'.format(case,1e3*old,1e3*new))
+        imports = compare_imports(report,baseline)
+        for case,added in imports.items():
+            print('REGRESSION {:s}: now imports {:s}'.format(case,', '.join(added)))
+        return 1 if regressions or imports else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+IEEE 488.2 definite-length binary block transfers.
+
+A block arrives as '#', one digit n, n digits giving the payload length, then the
+payload itself, usually followed by the message terminator. The payload is read
+straight into a preallocated buffer (a fresh NumPy array, or one supplied by the
+caller) and returned as a typed NumPy view of that buffer, with no intermediate copy
+and no ASCII formatting or parsing. Requires numpy.
+'''
+
+import numpy as np
+
+def read_exact(read,count):
+    '''
+    Read exactly count bytes, raising TimeoutError if the device stops short.
+
+    args:
+
+        - read: callable(count) returning bytes, at most count of them
+
+        - count: int
+    '''
+    data = read(count)
+    if len(data) < count:
+        raise TimeoutError('Binary block transfer timed out after {:d} of {:d} bytes.'.format(len(data),count))
+    return data
+
+def parse_header(read,max_skip=64):
+    '''
+    Read a definite-length block header, skipping any stray bytes (e.g. whitespace)
+    before the '#'.
+
+    args:
+
+        - read: callable(count) returning bytes
+
+        - max_skip: int, number of bytes to look through for the '#'
+
+    return:
+
+        - length: int, payload length in bytes
+    '''
+    for _ in range(max_skip):
+        if read_exact(read,1) == b'#':
+            break
+    else:
+        raise ValueError('No binary block header found in the reply.')
+    digits = read_exact(read,1)
+    if not digits.isdigit():
+        raise ValueError('Malformed binary block header #{:s}.'.format(str(digits)))
+    if digits == b'0':
+        raise ValueError('Indefinite-length (#0) blocks are not supported.')
+    size = read_exact(read,int(digits))
+    if not size.isdigit():
+        raise ValueError('Malformed binary block length {:s}.'.format(str(size)))
+    return int(size)
+
+def readinto_from(read,chunk_size=65536):
+    '''
+    Adapt a read(count) callable to readinto(view), for transports that can only
+    return bytes. Each chunk is copied once, into its final place in the buffer.
+    '''
+    def readinto(view):
+        data = read(min(len(view),chunk_size))
+        view[:len(data)] = data
+        return len(data)
+    return readinto
+
+def block_dtype(dtype,endianness):
+    dtype = np.dtype(dtype)
+    if endianness is None:
+        return dtype
+    return dtype.newbyteorder({'little':'<','big':'>'}.get(endianness,endianness))
+
+def read_block(read,readinto=None,dtype='f4',endianness='>',out=None,trailer=0):
+    '''
+    Read one binary block and return its payload as a typed array view.
+
+    args:
+
+        - read: callable(count) returning bytes, used for the header and trailer
+
+        - readinto: callable(memoryview) filling the view and returning the byte count. Built from read if None.
+
+        - dtype: NumPy dtype of the payload elements
+
+        - endianness: '>'/'big' (IEEE 488.2 normal order), '<'/'little' (swapped), or None to keep dtype as given
+
+        - out: writable bytearray or contiguous NumPy array to read into. A new buffer is allocated if None.
+
+        - trailer: int, bytes to consume after the payload (the message terminator)
+
+    return:
+
+        - values: NumPy array of dtype, a view of the buffer the payload was read into
+    '''
+    dtype = block_dtype(dtype,endianness)
+    length = parse_header(read)
+    if length % dtype.itemsize:
+        raise ValueError('Block of {:d} bytes does not hold a whole number of {:s} values.'.format(length,str(dtype)))
+
+    if out is None:
+        raw = np.empty(length,dtype=np.uint8)
+    elif isinstance(out,np.ndarray):
+        if not (out.flags.c_contiguous and out.flags.writeable):
+            raise ValueError('Output array must be contiguous and writeable.')
+        raw = out.reshape(-1).view(np.uint8)
+    else:
+        raw = np.frombuffer(out,dtype=np.uint8)
+    if raw.nbytes < length:
+        raise ValueError('Buffer of {:d} bytes is too small for a {:d} byte block.'.format(raw.nbytes,length))
+
+    if readinto is None:
+        readinto = readinto_from(read)
+    view = memoryview(raw)[:length]
+    received = 0
+    while received < length:
+        count = readinto(view[received:])
+        if not count:
+            raise TimeoutError('Binary block transfer timed out after {:d} of {:d} bytes.'.format(received,length))
+        received += count
+    if trailer:
+        read(trailer)
+    return raw[:length].view(dtype)
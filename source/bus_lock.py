@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Process-wide locks, one per physical bus, so that concurrent callers (threads,
+pollers or coroutines running I/O in worker threads) never interleave bytes on
+the same serial port or GPIB board.
+'''
+
+import threading
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+def get_lock(bus):
+    '''
+    Get the lock guarding a bus. Connections that do not report a bus get a
+    lock of their own.
+
+    args:
+
+        - bus: hashable bus identifier, or None
+
+    return:
+
+        - lock: threading.RLock
+    '''
+    if bus is None:
+        return threading.RLock()
+    with _locks_lock:
+        if bus not in _locks:
+            _locks[bus] = threading.RLock()
+        return _locks[bus]
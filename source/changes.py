@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Change detection for status readings.
+
+Each status update is compared with the values last reported, and only the
+readings that changed are passed on. A numeric status command can be given a
+'Deadband' option in the command dictionary. Its reading then only counts as
+changed once it has moved by more than the deadband from the last reported value,
+so slow drift is still reported once it adds up:
+
+    'Measure output voltage':('MEAS#:VOLT?', True, {'Deadband':0.001}),
+
+Other readings count as changed whenever they differ at all. Consumers subscribe
+to a Device with a callback, or iterate a ChangeStream, and so only do work for
+what changed.
+'''
+
+import collections
+import threading
+
+def as_number(value):
+
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return None
+
+class ChangeDetector:
+
+    def __init__(self,deadbands=None):
+        '''
+        args:
+
+            - deadbands: dictionary, status command:deadband, for commands compared numerically
+        '''
+        self.deadbands = deadbands or {}
+        self.reported = {}
+
+    @classmethod
+    def for_device(cls,device):
+        '''
+        Detector using the 'Deadband' options of a device's status commands.
+        '''
+        return cls({command:device.Templates[command].options['Deadband'] for command in device.StatusCommands
+                    if 'Deadband' in device.Templates[command].options})
+
+    def changed(self,key,value):
+        '''
+        Check one reading against the value last reported for it.
+        '''
+        if key not in self.reported:
+            return True
+        old = self.reported[key]
+        deadband = self.deadbands.get(key)
+        if deadband is not None:
+            new_number,old_number = as_number(value),as_number(old)
+            if new_number is not None and old_number is not None:
+                return abs(new_number - old_number) > deadband
+        return value != old
+
+    def update(self,readings):
+        '''
+        Compare a set of readings with those last reported, and remember the ones that changed.
+
+        args:
+
+            - readings: dictionary, status command:reading
+
+        return:
+
+            - changes: dictionary, status command:new reading, for readings that changed
+        '''
+        changes = {key:value for key,value in readings.items() if self.changed(key,value)}
+        self.reported.update(changes)
+        return changes
+
+    def reset(self):
+        '''
+        Forget the reported values, so that the next update reports everything.
+        '''
+        self.reported.clear()
+
+class ChangeStream:
+
+    def __init__(self,device,maxsize=1000):
+        '''
+        Iterable of a device's status changes, as (timestamp, changes) pairs, in order.
+        Subscribes on creation; close() unsubscribes and ends the iteration. If the
+        consumer falls more than maxsize updates behind, the oldest are dropped and
+        counted in dropped.
+
+        args:
+
+            - device: Device instance
+
+            - maxsize: int, updates held for the consumer
+        '''
+        self.device = device
+        self.items = collections.deque(maxlen=maxsize)
+        self.ready = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+        device.subscribe(self.push)
+
+    def push(self,device,changes,timestamp):
+
+        with self.ready:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append((timestamp,changes))
+            self.ready.notify()
+
+    def get(self,timeout=None):
+        '''
+        Next update, waiting up to timeout seconds.
+
+        return:
+
+            - (timestamp, changes), or None on timeout or once closed and drained
+        '''
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.items or self.closed,timeout):
+                return None
+            if self.items:
+                return self.items.popleft()
+            return None
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+
+        self.device.unsubscribe(self.push)
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Parameterized command strings.
+
+Command strings in an instrument's command dictionary may carry a '#' channel
+placeholder and typed argument slots, e.g. 'SOUR#:VOLT <float>' or 'OUTP# <bool>'.
+Each string is parsed once, when the device is set up, into a CommandTemplate
+holding a ready-made format string and a reply parser, so that sending a command
+or reading back a typed reply does no string parsing per call.
+'''
+
+import re
+
+_slot = re.compile(r'<(\w+)>')
+
+def format_bool(value):
+    return '1' if value else '0'
+
+def parse_bool(reply):
+    reply = reply.strip().upper()
+    if reply in ('1','ON','TRUE'):
+        return True
+    if reply in ('0','OFF','FALSE'):
+        return False
+    raise ValueError('Cannot interpret {:s} as a boolean.'.format(reply))
+
+def parse_number(reply):
+    try:
+        return float(reply)
+    except ValueError:
+        return reply
+
+# slot name: (type, formatter for outgoing values, parser for replies)
+slot_types = {'float':(float,lambda value: str(float(value)),float),
+              'int':(int,lambda value: str(int(value)),lambda reply: int(float(reply))),
+              'bool':(bool,format_bool,parse_bool),
+              'str':(str,str,str)}
+
+parsers = {float:float,
+           int:slot_types['int'][2],
+           bool:parse_bool,
+           str:str}
+
+class CommandTemplate:
+
+    def __init__(self,text,reply_type=None,options=None):
+        '''
+        Parse a command string.
+
+        args:
+
+            - text: string, command string with optional '#' channel placeholder and <float>/<int>/<bool>/<str> slots
+
+            - reply_type: type, one of float, int, bool, str, for the reply to a query. If None, replies that
+            look like numbers are returned as floats and anything else as a string.
+
+            - options: dictionary, the options given with the command in the command dictionary
+        '''
+        self.text = text
+        self.options = options or {}
+        self.header = text.split(' ')[0]
+        self.is_query = self.header.endswith('?')
+        self.header_pattern = re.compile(r'(\d*)'.join(re.escape(part) for part in self.header.lstrip(':').split('#')) + '$',re.IGNORECASE)
+        self.has_channel = '#' in text
+        self.arguments = []
+        self.formatters = []
+
+        pattern = text.replace('{','{{').replace('}','}}').replace('#','{channel}')
+        for index,match in enumerate(_slot.finditer(text)):
+            if match.group(1) not in slot_types:
+                raise ValueError('Unknown argument type <{:s}> in command {:s}.'.format(match.group(1),text))
+            argtype,formatter,_ = slot_types[match.group(1)]
+            self.arguments.append(argtype)
+            self.formatters.append(formatter)
+            pattern = pattern.replace(match.group(0),'{'+str(index)+'}',1)
+        self.pattern = pattern
+
+        self.reply_type = reply_type
+        self.parser = parsers[reply_type] if reply_type is not None else parse_number
+
+    def format(self,channel=None,value=None):
+        '''
+        Fill in the template.
+
+        args:
+
+            - channel: int, substituted for '#'. Left empty if None, which SCPI reads as the default channel.
+
+            - value: argument for a single-slot command, or a tuple of arguments for several slots.
+
+        return:
+
+            - message: string, command ready to be built and sent
+        '''
+        if not self.arguments:
+            values = ()
+        elif len(self.arguments) == 1:
+            values = (value,)
+        else:
+            values = tuple(value)
+        if len(values) != len(self.arguments) or (self.arguments and value is None):
+            raise ValueError('Command {:s} takes {:d} argument(s).'.format(self.text,len(self.arguments)))
+        channel = '' if channel is None else channel
+        return self.pattern.format(*[formatter(argument) for formatter,argument in zip(self.formatters,values)],channel=channel)
+
+    def match(self,header):
+        '''
+        Check whether a message header was produced by this template.
+
+        args:
+
+            - header: string, first word of a message, without leading ':'
+
+        return:
+
+            - channel: int or None if matched (None when the template has no channel), otherwise False
+        '''
+        match = self.header_pattern.match(header)
+        if match is None:
+            return False
+        if match.groups() and match.group(1):
+            return int(match.group(1))
+        return None
+
+    def parse(self,reply):
+        '''
+        Convert a reply string to the reply type of this command.
+
+        args:
+
+            - reply: string, as returned by the device
+
+        return:
+
+            - value: reply converted to the reply type
+        '''
+        return self.parser(reply.strip())
+
+def compile_commands(all_commands):
+    '''
+    Compile a command dictionary into CommandTemplates. Entries are structured
+    'Command Description':('Command', Bool) or ('Command', Bool, options), where
+    options is a dictionary. The option 'Type' sets the reply type of a query.
+    Without it, a query takes the argument type of the setter with the same
+    header, so that 'SOUR#:VOLT?' replies as a float because of 'SOUR#:VOLT <float>'.
+
+    args:
+
+        - all_commands: dictionary of commands, as passed to Device.initialize_device
+
+    return:
+
+        - Templates: dictionary, plain text label:CommandTemplate
+    '''
+    setter_types = {}
+    for ci in all_commands:
+        template = CommandTemplate(all_commands[ci][0])
+        if not template.is_query and template.arguments:
+            setter_types[template.header] = template.arguments[0]
+
+    Templates = {}
+    for ci in all_commands:
+        options = all_commands[ci][2] if len(all_commands[ci]) > 2 else {}
+        text = all_commands[ci][0]
+        reply_type = options.get('Type')
+        if reply_type is None and text.split(' ')[0].endswith('?'):
+            reply_type = setter_types.get(text.split(' ')[0][:-1])
+        Templates[ci] = CommandTemplate(text,reply_type,options)
+    return Templates
@@ -9,7 +9,9 @@ Created on Mon Jun 29 17:22:32 2020
 @author: ryanday
 """
 
-class Custom:
+from . import transport
+
+class Custom(transport.Transport):
 
 
     def __init__(self,address):
@@ -7,9 +7,15 @@
 
 import datetime as dt
 import time
-from . import visa_module
-from . import serial_module as serial
+import warnings
+import weakref
 from . import custom_module as custom
+from . import bus_lock
+from . import command_template
+from . import errors
+from . import retry
+from . import transport
+from . import changes as status_changes
 
 class Device:
 
@@ -27,20 +33,65 @@ class Device:
 
     The connection args will be a dictionary. It will contain the key:value pairs
 
-        Protocol: string, 'RS232','GPIB',...
+        Protocol: string, 'RS232','GPIB','Serial_VISA','Sim',... or any protocol added with transport.register or an entry point
         Address: string, name of com-port
         ErrorScheme: ... details of error detection scheme for device
         Baud: int
         Terminator: char
-
-    TODO: implement a way to translate between Plain Text commands and command-strings so that the argument to write can be human readable.
+        Backend: string, VISA only. pyvisa backend, default '@py'. Connections on the same backend share a ResourceManager.
+        Timeout: float, seconds allowed for a single exchange with the device. Also bounds the awaitable (a-prefixed) methods.
+        CompoundQueries: bool, SCPI only. Join status queries with ';' into as few messages as MaxMessageLength allows (default False).
+        MaxMessageLength: int, longest message the device accepts, in characters (default 256).
+        BlockTrailer: int, VISA only. Bytes following a binary block reply (default 1 for GPIB, the terminator length for Serial_VISA).
+        Persistent: bool, RS232 only. Keep the port open between calls (default), or open it per call if False.
+        Port, NoDelay, KeepAlive, Reconnect: TCP only, see socket_module.
+        MaxRate: float, most transactions per second the device's bus should carry, honoured by scheduler.PollScheduler.
+
+    Every blocking method has an awaitable counterpart (awrite, aread, aquery, aquery_many, aget_status) that runs the
+    I/O in a worker thread. All calls on the same bus are serialized through a shared lock, so coroutines,
+    threads and pollers can use the same connection without interleaving messages.
+
+    Command strings may contain a '#' channel placeholder and typed argument slots such as <float>, <int> or <bool>.
+    They are compiled once into Templates, so that a command can be sent by its Plain Text name, e.g.
+    command('Set output voltage', channel=1, value=3.2), and a query comes back as a typed value.
+    An optional third element in a command tuple holds a dictionary of options; 'Type' sets the reply type of a query,
+    'TTL' lets a query's reply be cached for that many seconds (see enable_query_cache), and 'Invalidates' lists
+    further queries whose cached replies a setter makes stale. 'Period' and 'Priority' set how often and how urgently
+    a status command is polled by scheduler.PollScheduler. 'Deadband' sets how far a numeric status reading must move
+    before it counts as changed. 'Timeout' gives a command its own timeout in seconds, e.g. for a slow measurement.
+
+    Failed exchanges are repeated with backoff as the connection's retry.RetryPolicy allows (see set_retry_policy),
+    then raise an errors.InstrumentError rather than returning an empty string. enable_circuit_breaker makes a
+    device that keeps failing fail at once, instead of costing a timeout per call, until a background probe succeeds.
+
+    A status command that fails reads as an errors.ErrorReading, with the error in StatusErrors, rather than
+    stopping the rest of the sweep.
+
+    Each status update reports which readings changed (see changes): get_status returns them, and callbacks
+    registered with subscribe, or a change_stream, receive them.
 
 
     '''
+    # Set simulate to True (on Device, a subclass, or an instance before initialize_device) to run against
+    # the in-process Sim protocol instead of hardware. simulation_args are merged into the communication
+    # arguments, e.g. to give the simulated instrument a response table or latency.
+    simulate = False
+    simulation_args = {}
+    recorder = None
+    acquisition = None
+    write_buffer = None
+    query_cache = None
+    subscribers = ()
+    # consecutive unusable compound replies after which compound queries are switched off
+    compound_fallback_after = 3
+    compound_mismatches = 0
+    # queries sent through exchange(), e.g. for scheduler.PollScheduler to rate-limit what actually went out
+    exchanges = 0
+
     def __init__(self):
-            return 0
+            pass
 
-    def initialize_device(self,name,communication_args,commands):
+    def initialize_device(self,name,communication_args,commands,Templates=None):
         '''
         Instantiate the device class. User passes a device identifier,
         in addition to requisite arguments to establish communication protocol, as well as the commands of interest. The values for commands are mixed tuple of string and boolean, indicating the device query-string, and whether or not the command is desired for monitoring.
@@ -53,13 +104,46 @@ class Device:
 
             - commands: dictionary, command strings for communicating with device.
 
+            - Templates: dictionary, commands already compiled with command_template.compile_commands, e.g. shared from an InstrumentSpec. Compiled here if None.
+
         '''
 
 
         self.name = name
         self.connection = self.initialize_connection(communication_args)
+        self.lock = bus_lock.get_lock(getattr(self.connection,'bus',None))
+        self.async_locks = weakref.WeakKeyDictionary()
         self.CommandTable,self.StatusCommands,self.Status = self.instantiate_commands(commands)
+        self.Templates = Templates if Templates is not None else command_template.compile_commands(commands)
+        self.compound_queries = communication_args.get('CompoundQueries',False)
+        self.max_message_length = communication_args.get('MaxMessageLength',256)
+        self.max_rate = communication_args.get('MaxRate')
+        self.StatusBatches = self.compile_status_batches()
+        self.change_detector = status_changes.ChangeDetector.for_device(self)
+        self.StatusChanges = {}
+        self.StatusErrors = {}
+        self.command_timeouts = {template.text:template.options['Timeout'] for template in self.Templates.values()
+                                 if 'Timeout' in template.options}
+        if self.command_timeouts:
+            self.set_retry_policy(self.connection.policy)
+
+
+    def initialize_spec(self,spec,address=None,**communication_args):
+        '''
+        Set up the device from a compiled instrument definition (see instrument_spec).
+        The command templates are shared with the spec rather than compiled again.
+
+        args:
+
+            - spec: InstrumentSpec
 
+            - address: string, device address. Defaults to the address in the spec.
+
+            - communication_args: further communication arguments overriding the spec
+        '''
+        self.limits = spec.limits
+        self.communication_args = spec.connection_args(address,**communication_args)
+        self.initialize_device(spec.name,self.communication_args,spec.commands,spec.Templates)
 
     def initialize_connection(self,connection_args):
         '''
@@ -75,20 +159,192 @@ class Device:
 
         '''
 
-        if connection_args['Protocol'] == 'GPIB':
-            connection = visa_module.GPIB(connection_args)
-        elif connection_args['Protocol'] == 'Serial_VISA':
-            connection = visa_module.Serial(connection_args)
-        elif connection_args['Protocol'] == 'RS232':
-            connection = serial.RS232(connection_args)
+        if self.simulate:
+            connection_args = dict(connection_args,**self.simulation_args)
+            connection_args['Protocol'] = 'Sim'
+
+        protocol = transport.get(connection_args['Protocol'])
+        if protocol is not None:
+            connection = protocol(connection_args)
         else:
             print('LCMI is not familiar with the {:s} protocol. You will have to give us more information.'.format(connection_args['Protocol']))
             connection = custom.Custom(connection_args)
 
         return connection
 
+    def enable_write_buffer(self,window=0.05):
+        '''
+        Coalesce setpoint commands sent through command(): only the latest value per
+        command and channel is kept within the window, and values equal to the last
+        one sent are dropped. Pending writes are sent before any query or raw write.
+
+        args:
+
+            - window: float, seconds a setpoint may be held back. 0 holds it until flush_writes().
+
+        return:
+
+            - write_buffer: WriteBuffer, whose stats count submitted, dropped, superseded and sent writes
+        '''
+        from . import write_buffer
+        self.disable_write_buffer()
+        self.write_buffer = write_buffer.WriteBuffer(self,window)
+        return self.write_buffer
+
+    def disable_write_buffer(self):
+        '''
+        Send any pending setpoints and stop buffering.
+        '''
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+            self.write_buffer = None
+
+    def enable_query_cache(self):
+        '''
+        Reuse replies to queries that have a 'TTL' option until they expire. Writes
+        through this device drop the cached replies they affect (see query_cache).
+
+        return:
+
+            - query_cache: QueryCache, whose stats count hits, misses and invalidations
+        '''
+        from . import query_cache
+        self.query_cache = query_cache.QueryCache(self.Templates)
+        return self.query_cache
+
+    def disable_query_cache(self):
+        '''
+        Stop caching query replies.
+        '''
+        self.query_cache = None
+
+    def flush_writes(self):
+        '''
+        Send any pending setpoints now.
+        '''
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+
+    def start_acquisition(self,commands,rate,size=10000,channel=None):
+        '''
+        Sample commands continuously in a background thread, into a ring buffer of
+        timestamped readings (see acquisition). Requires numpy.
+
+        args:
+
+            - commands: list of command names, queried each sample; replies are stored as floats
+
+            - rate: float, samples per second
+
+            - size: int, number of samples kept
+
+            - channel: int, channel substituted into templated commands
+
+        return:
+
+            - acquisition: Acquisition, whose latest(n) and view(n) read the most recent samples
+        '''
+        from . import acquisition
+        self.stop_acquisition()
+        self.acquisition = acquisition.Acquisition(self,commands,rate,size,channel)
+        self.acquisition.start()
+        return self.acquisition
+
+    def stop_acquisition(self):
+        '''
+        Stop background acquisition, if running. The buffer stays readable.
+        '''
+        if self.acquisition is not None:
+            self.acquisition.stop()
+
+    def enable_metrics(self,registry=None):
+        '''
+        Start recording per-command timings and error counters on this device's connection.
+
+        args:
+
+            - registry: metrics.Metrics instance. Defaults to the shared metrics.registry.
+
+        return:
+
+            - registry: the Metrics instance in use
+        '''
+        from . import metrics
+        if registry is None:
+            registry = metrics.registry
+        self.connection.metrics = registry
+        return registry
+
+    def disable_metrics(self):
+        '''
+        Stop recording metrics on this device's connection.
+        '''
+        self.connection.metrics = None
+
+    def set_retry_policy(self,policy):
+        '''
+        Give this device's connection its own retry policy. The 'Timeout' options of the
+        device's commands are added to it.
+
+        args:
+
+            - policy: retry.RetryPolicy
+        '''
+        if self.command_timeouts:
+            policy = policy.with_timeouts(self.command_timeouts)
+        self.connection.policy = policy
+
+    def enable_circuit_breaker(self,threshold=3,probe_interval=5.0,probe_message='*IDN?'):
+        '''
+        Stop calling a device that keeps failing. After threshold exchanges in a row fail,
+        calls raise errors.DeviceUnavailable at once. Every probe_interval seconds a
+        background thread sends probe_message, and calls go through again once it is answered.
+
+        args:
+
+            - threshold: int, consecutive failed exchanges that mark the device unhealthy
+
+            - probe_interval: float, seconds between probes
+
+            - probe_message: string, harmless query the device always answers. If None, the
+            next regular call after each interval is let through as the probe.
+
+        return:
+
+            - breaker: retry.CircuitBreaker
+        '''
+        self.disable_circuit_breaker()
+        probe = None
+        if probe_message is not None:
+            message = self.connection.build(probe_message)
+
+            def probe():
+                with self.lock:
+                    self.connection.query(message)
+
+        self.connection.breaker = retry.CircuitBreaker(threshold,probe_interval,probe)
+        return self.connection.breaker
+
+    def disable_circuit_breaker(self):
+
+        breaker = self.connection.breaker
+        if breaker is not None:
+            self.connection.breaker = None
+            breaker.close()
+
+    def is_healthy(self):
+        '''
+        False while the circuit breaker has the device marked as failing.
+        '''
+        return self.connection.breaker is None or self.connection.breaker.is_healthy()
+
     def close_connection(self):
 
+        self.stop_acquisition()
+        self.stop_recording()
+        self.disable_write_buffer()
+        if not self.connection.shared_breaker:
+            self.disable_circuit_breaker()
         return self.connection.close()
 
     def instantiate_commands(self,all_commands):
@@ -124,17 +380,248 @@ class Device:
 
         return CommandTable,StatusCommands,Status
 
+    def compile_status_batches(self):
+        '''
+        Group the status commands into the wire transactions used by get_status.
+        Without compound queries every command is its own transaction. With them,
+        consecutive commands are packed together as long as the joined message
+        fits in max_message_length.
+
+        return:
+
+            - batches: list of lists of StatusCommands keys
+        '''
+        if not self.compound_queries:
+            return [[command] for command in self.StatusCommands]
+
+        batches = []
+        length = 0
+        for command in self.StatusCommands:
+            size = len(self.StatusCommands[command]) + 2
+            if batches and length + size <= self.max_message_length:
+                batches[-1].append(command)
+                length += size
+            else:
+                batches.append([command])
+                length = size
+        return batches
+
+    def compound_message(self,commands):
+        '''
+        Join several SCPI queries into one message. Every query after the first is
+        rooted with ':' (unless it is a common '*' command), so that it is not read
+        relative to the subsystem of the one before it.
+
+        args:
+
+            - commands: list of StatusCommands keys
+
+        return:
+
+            - message: string
+        '''
+        parts = [self.StatusCommands[commands[0]]]
+        for command in commands[1:]:
+            part = self.StatusCommands[command]
+            if not part.startswith((':','*')):
+                part = ':' + part
+            parts.append(part)
+        return ';'.join(parts)
+
+    def query_status_batch(self,commands):
+        '''
+        Query one batch of status commands and split the reply back per command.
+        If a compound reply cannot be split into one value per command, the batch
+        is queried one command at a time instead. Compound queries are switched off
+        for the device when it answers with fewer values than queries, which is how
+        devices that do not accept them respond. They are also switched off after
+        compound_fallback_after unusable replies in a row, but a single glitch does
+        not turn them off. No reply at all is not counted: it says nothing about
+        compound queries, and a dead device is not queried once per command on top.
+
+        A command whose query fails reads as an errors.ErrorReading and its error is
+        kept in StatusErrors until it reads again, so the other readings still arrive.
+
+        args:
+
+            - commands: list of StatusCommands keys
+
+        return:
+
+            - readings: dictionary, StatusCommands key:reply string, or errors.ErrorReading
+        '''
+        readings = {}
+        if self.query_cache is not None:
+            # serve what the cache holds and only put the rest on the wire
+            self.flush_writes()
+            for command in commands:
+                hit,reply = self.query_cache.get(self.connection.build(self.StatusCommands[command]))
+                if hit:
+                    readings[command] = reply
+            commands = [command for command in commands if command not in readings]
+            if not commands:
+                return readings
+
+        if len(commands) == 1:
+            readings[commands[0]] = self.status_reading(commands[0])
+        else:
+            try:
+                values = self.exchange(self.connection.build(self.compound_message(commands))).split(';')
+            except (errors.DeviceTimeout,errors.DeviceUnavailable) as error:
+                for command in commands:
+                    self.StatusErrors[command] = error
+                readings.update({command:errors.ErrorReading(error) for command in commands})
+                values = []
+            except errors.InstrumentError:
+                # not the device's answer to a compound query; try the commands singly this time
+                values = None
+            if values == [] or values == ['']:
+                # no reply; empty readings as a single query would give with raise_errors=False
+                readings.update({command:'' for command in commands if command not in readings})
+            elif values is None:
+                readings.update({command:self.status_reading(command) for command in commands})
+            elif len(values) == len(commands):
+                self.compound_mismatches = 0
+                for command in commands:
+                    self.StatusErrors.pop(command,None)
+                readings.update({command:value.strip() for command,value in zip(commands,values)})
+            else:
+                self.compound_mismatches += 1
+                refused = len(values) < len(commands) and any(value.strip() for value in values)
+                if refused or self.compound_mismatches >= self.compound_fallback_after:
+                    warnings.warn('{:s} did not accept a compound query; falling back to one query per status command.'.format(str(self.name)))
+                    self.compound_queries = False
+                    self.StatusBatches = self.compile_status_batches()
+                readings.update({command:self.status_reading(command) for command in commands})
+
+        if self.query_cache is not None:
+            for command in commands:
+                if not isinstance(readings[command],errors.ErrorReading):
+                    self.query_cache.put(self.connection.build(self.StatusCommands[command]),readings[command])
+        return readings
+
+    def status_reading(self,command):
+        '''
+        Query a single status command. If the query fails, the error is kept in
+        StatusErrors and an errors.ErrorReading is returned in place of the reply.
+        '''
+        try:
+            reply = self.exchange(self.connection.build(self.StatusCommands[command]))
+        except errors.InstrumentError as error:
+            self.StatusErrors[command] = error
+            return errors.ErrorReading(error)
+        self.StatusErrors.pop(command,None)
+        return reply
+
     def get_status(self):
 
         '''
         Iterate through all requisite status commands and query the instrument.
         Time of query is also recorded (once for the entire set of readings).
+        With compound queries enabled, the commands are sent in as few messages as possible.
+        A command that fails is stored as an errors.ErrorReading and does not stop the
+        others; StatusErrors holds the errors of the commands currently failing.
 
+        return:
+
+            - changes: dictionary, status command:new reading, for readings that changed (see update_status)
         '''
-        self.Status['DateTime'] = dt.datetime.now().strftime('%H:%M:%S %d/%m/%y')
-        for command in self.StatusCommands:
-            writestring = self.connection.build(self.StatusCommands[command])
-            self.Status[command] = self.connection.query(writestring)
+        changes = self.update_status(self.read_status())
+        if self.recorder is not None:
+            self.recorder.record(self.Status,self.StatusTimestamp)
+        return changes
+
+    def read_status(self):
+        '''
+        Query every status batch, holding the bus lock for the whole sweep so that
+        other callers' messages cannot come in between. Status is not updated.
+
+        return:
+
+            - readings: dictionary, status command:reply string
+        '''
+        readings = {}
+        with self.lock:
+            self.StatusTimestamp = time.time_ns()
+            self.Status['DateTime'] = dt.datetime.now().strftime('%H:%M:%S %d/%m/%y')
+            for commands in self.StatusBatches:
+                readings.update(self.query_status_batch(commands))
+        return readings
+
+    def update_status(self,readings):
+        '''
+        Store new status readings, work out which changed beyond their deadband since
+        last reported, and pass those on to subscribers.
+
+        args:
+
+            - readings: dictionary, status command:reading
+
+        return:
+
+            - changes: dictionary, status command:new reading. Also kept as StatusChanges.
+        '''
+        self.Status.update(readings)
+        changes = self.change_detector.update(readings)
+        self.StatusChanges = changes
+        if changes:
+            for callback in self.subscribers:
+                try:
+                    callback(self,changes,self.StatusTimestamp)
+                except Exception as error:
+                    print('Status subscriber {:s} of {:s} failed: {:s}'.format(repr(callback),str(self.name),repr(error)))
+        return changes
+
+    def subscribe(self,callback):
+        '''
+        Call callback(device, changes, timestamp) after every status update in which
+        some reading changed. Callbacks run in the thread that polled the device.
+
+        args:
+
+            - callback: callable; changes is a dictionary of status command:new reading, timestamp is epoch nanoseconds
+        '''
+        self.subscribers = tuple(self.subscribers) + (callback,)
+
+    def unsubscribe(self,callback):
+
+        self.subscribers = tuple(subscriber for subscriber in self.subscribers if subscriber != callback)
+
+    def change_stream(self,maxsize=1000):
+        '''
+        Iterable of (timestamp, changes) for every status update with changes,
+        until its close() is called; see changes.ChangeStream.
+        '''
+        return status_changes.ChangeStream(self,maxsize)
+
+    def start_recording(self,path,**options):
+        '''
+        Record every subsequent get_status cycle to a binary status log (see status_logger).
+        Requires numpy.
+
+        args:
+
+            - path: string, base name of the log files
+
+            - options: keyword arguments for status_logger.StatusRecorder, e.g. chunk_rows, max_file_bytes
+
+        return:
+
+            - recorder: StatusRecorder
+        '''
+        from . import status_logger
+        self.stop_recording()
+        options.setdefault('metadata',{'Device':str(self.name)})
+        self.recorder = status_logger.StatusRecorder(path,list(self.StatusCommands),**options)
+        return self.recorder
+
+    def stop_recording(self):
+        '''
+        Flush and close the status log, if one is being recorded.
+        '''
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def print_commands(self):
         '''
@@ -153,18 +640,233 @@ class Device:
 
         '''
         Print current device status, as last queried.
-        TODO: this is not safe against different key-value types, must all be formatted as strings
         '''
-        print('\n'.join([' {:s} | {:s} |'.format(si,self.Status[si]) for si in self.Status]))
+        print('\n'.join([' {:s} | {:s} |'.format(str(si),str(self.Status[si])) for si in self.Status]))
+
+    def print_changes(self):
+        '''
+        Print the status readings that changed in the last update.
+        '''
+        print('\n'.join([' {:s} | {:s} |'.format(str(si),str(self.StatusChanges[si])) for si in self.StatusChanges]))
 
     def write(self,message):
 
-        return self.connection.write(message)
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+            self.write_buffer.forget()
+        return self.send(message)
+
+    def send(self,message):
+        '''
+        Write a message straight to the connection, bypassing the write buffer,
+        and drop any cached replies it makes stale.
+        '''
+        with self.lock:
+            result = self.connection.write(message)
+        if self.query_cache is not None:
+            self.query_cache.invalidate(message)
+        return result
 
     def read(self):
 
-        return self.connection.read()
+        with self.lock:
+            return self.connection.read()
 
     def query(self, query_message):
 
-        return self.connection.query(query_message)
+        if self.query_cache is None:
+            return self.exchange(query_message)
+        # pending setpoints go out first, so that they invalidate what they affect
+        self.flush_writes()
+        hit,reply = self.query_cache.get(query_message)
+        if hit:
+            return reply
+        reply = self.exchange(query_message)
+        self.query_cache.put(query_message,reply)
+        return reply
+
+    def exchange(self,query_message):
+        '''
+        Query the device, bypassing the query cache. Pending buffered writes go out first.
+        '''
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+        with self.lock:
+            self.exchanges += 1
+            return self.connection.query(query_message)
+
+    def query_many(self,query_messages):
+        '''
+        Send a batch of queries in one turn on the bus, pipelined if the transport
+        supports it. The query cache is not consulted.
+
+        args:
+
+            - query_messages: list of built query messages
+
+        return:
+
+            - replies: list of strings, in order
+        '''
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+        with self.lock:
+            return self.connection.query_many(query_messages)
+
+    def query_binary(self,query_message,dtype='f4',endianness='>',out=None):
+        '''
+        Query a binary block (IEEE 488.2 definite-length format) and return it as a
+        typed NumPy array view, without ASCII formatting on either end. Requires numpy.
+
+        args:
+
+            - query_message: query to transmit, as for query()
+
+            - dtype: NumPy dtype of the payload elements
+
+            - endianness: '>' (IEEE 488.2 normal byte order) or '<', or None to use dtype as given
+
+            - out: bytearray or NumPy array to read into, reused between calls to avoid allocation
+
+        return:
+
+            - values: NumPy array view of the payload
+        '''
+        with self.lock:
+            return self.connection.query_binary(query_message,dtype,endianness,out)
+
+    def command(self,name,channel=None,value=None):
+        '''
+        Send a command by its Plain Text name. Queries return the reply converted
+        to the command's reply type; other commands are written and return None.
+        With a write buffer enabled, setpoint commands (those taking an argument) are
+        coalesced rather than sent straight away; see enable_write_buffer.
+
+        args:
+
+            - name: string, key of the command in CommandTable
+
+            - channel: int, channel number substituted for '#'
+
+            - value: argument for the command, or a tuple of arguments if it takes several
+
+        return:
+
+            - reply: typed reply for queries, otherwise None
+        '''
+        template = self.Templates[name]
+        if self.write_buffer is not None and not template.is_query:
+            if template.arguments:
+                self.write_buffer.submit(name,channel,value)
+                return
+            self.write_buffer.flush()
+            self.write_buffer.forget()
+        message = self.connection.build(template.format(channel,value))
+        if template.is_query:
+            return template.parse(self.query(message))
+        self.send(message)
+
+    async def acommand(self,name,channel=None,value=None,timeout=None):
+
+        return await self.run_async(self.command,name,channel,value,timeout=timeout)
+
+    async def run_async(self,function,*args,timeout=None):
+        '''
+        Run a blocking call in a worker thread and await its result. Coroutines
+        using this device take turns, and the bus lock taken by the blocking call
+        keeps other threads off the wire in the meantime.
+
+        The timeout starts once the worker holds the bus lock, so time spent waiting
+        for other callers on the bus does not count against it. If the await times
+        out or is cancelled, the coroutine returns straight away but the worker
+        finishes its exchange first, so the bus is never left with a half-sent message.
+
+        args:
+
+            - function: callable, blocking method of this device
+
+            - timeout: float, seconds to wait. Defaults to exchange_budget(); no limit if the connection has no Timeout.
+
+        return:
+
+            - return value of function
+        '''
+        import asyncio
+        if timeout is None:
+            timeout = self.exchange_budget()
+        loop = asyncio.get_running_loop()
+        # an asyncio.Lock belongs to one event loop, so each loop using the device gets its own
+        async_lock = self.async_locks.get(loop)
+        if async_lock is None:
+            async_lock = self.async_locks[loop] = asyncio.Lock()
+        started = asyncio.Event()
+
+        def call():
+            with self.lock:
+                loop.call_soon_threadsafe(started.set)
+                return function(*args)
+
+        async with async_lock:
+            future = loop.run_in_executor(None,call)
+            waiting = asyncio.ensure_future(started.wait())
+            try:
+                await asyncio.wait([future,waiting],return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiting.cancel()
+            return await asyncio.wait_for(future,timeout)
+
+    def exchange_budget(self):
+        '''
+        Longest one exchange can take, in seconds: every attempt allowed by the connection's
+        retry policy running out of the longest timeout, plus the backoff between attempts.
+
+        return:
+
+            - budget: float, or None if the connection has no Timeout
+        '''
+        timeout = getattr(self.connection,'timeout',None)
+        policy = getattr(self.connection,'policy',None)
+        if timeout is None or policy is None:
+            return timeout
+        return policy.budget(max([timeout] + list(policy.timeouts.values())))
+
+    async def awrite(self,message,timeout=None):
+
+        return await self.run_async(self.write,message,timeout=timeout)
+
+    async def aread(self,timeout=None):
+
+        return await self.run_async(self.read,timeout=timeout)
+
+    async def aquery(self,query_message,timeout=None):
+
+        return await self.run_async(self.query,query_message,timeout=timeout)
+
+    async def aquery_many(self,query_messages,timeout=None):
+
+        return await self.run_async(self.query_many,query_messages,timeout=timeout)
+
+    async def aget_status(self,timeout=None):
+        '''
+        Awaitable get_status. The sweep runs in a worker thread holding the bus lock
+        throughout, as get_status does, so other coroutines on the event loop keep
+        running but no other caller's messages come in between.
+
+        args:
+
+            - timeout: float, seconds allowed per status transaction. Defaults to exchange_budget().
+
+        return:
+
+            - changes: dictionary, status command:new reading, for readings that changed
+        '''
+        if timeout is None:
+            timeout = self.exchange_budget()
+        if timeout is not None:
+            # a batch that falls back to one query per command costs one more transaction per command
+            timeout *= len(self.StatusBatches) + len(self.StatusCommands)
+        readings = await self.run_async(self.read_status,timeout=timeout)
+        changes = self.update_status(readings)
+        if self.recorder is not None:
+            self.recorder.record(self.Status,self.StatusTimestamp)
+        return changes
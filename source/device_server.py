@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Local device server: one process owns the instrument connections, any number of
+client processes share them.
+
+A DeviceServer holds a set of Devices and listens on a Unix socket. Clients, e.g. a
+GUI, a logger and a measurement script, each use a DeviceProxy, which has the
+same write/read/query/get_status API as the Device it stands for. Requests for
+each device go through that device's own queue and worker thread, so clients
+never interleave messages on a bus. Identical queries from different clients
+that are waiting in the queue at the same time share one bus transaction and all
+get its reply. A query never joins a transaction that has already gone out.
+A query never shares a transaction queued before a later write to the same device,
+so no client sees a reply older than its own writes.
+
+Run a server from instrument specs (see instrument_spec) with
+
+    python -m instrumentlibrary.source.device_server /tmp/lab.sock supply=rp100@ASRL5 [--simulate]
+
+and connect with DeviceProxy('supply', '/tmp/lab.sock').
+
+Wire format, big-endian. Every frame starts with uint32 payload length, uint32
+request id and uint8 opcode, followed by the payload: a sequence of strings, each
+a uint32 byte length (0xFFFFFFFF for None) and UTF-8 bytes. Requests carry the
+device name first, then any message. Replies echo the request id, with opcode 0
+and the results, or 1 and an error message.
+'''
+
+import os
+import queue
+import socket
+import struct
+import threading
+
+header = struct.Struct('!IIB')
+length = struct.Struct('!I')
+NONE = 0xFFFFFFFF
+
+WRITE,READ,QUERY,STATUS,LIST = 1,2,3,4,5
+OK,ERROR = 0,1
+
+def encode(strings):
+    '''
+    Pack a sequence of strings (or None) into a payload.
+    '''
+    parts = []
+    for string in strings:
+        if string is None:
+            parts.append(length.pack(NONE))
+        else:
+            data = string.encode('utf-8') if isinstance(string,str) else bytes(string)
+            parts.append(length.pack(len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+def decode(payload):
+    '''
+    Unpack a payload into a list of strings (or None).
+    '''
+    strings = []
+    offset = 0
+    while offset < len(payload):
+        size, = length.unpack_from(payload,offset)
+        offset += length.size
+        if size == NONE:
+            strings.append(None)
+        else:
+            strings.append(payload[offset:offset+size].decode('utf-8'))
+            offset += size
+    return strings
+
+def frame(request_id,opcode,strings):
+
+    payload = encode(strings)
+    return header.pack(len(payload),request_id,opcode) + payload
+
+def receive_exact(connection,count):
+
+    data = bytearray()
+    while len(data) < count:
+        chunk = connection.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError('Device server connection closed.')
+        data += chunk
+    return bytes(data)
+
+def receive_frame(connection):
+    '''
+    Read one frame.
+
+    return:
+
+        - (request id, opcode, list of strings)
+    '''
+    size,request_id,opcode = header.unpack(receive_exact(connection,header.size))
+    return request_id,opcode,decode(receive_exact(connection,size))
+
+def status_strings(status):
+    '''
+    Flatten a Status dictionary into alternating names and values, as strings.
+    '''
+    strings = []
+    for name,value in status.items():
+        strings.append(name)
+        strings.append(None if value is None else str(value))
+    return strings
+
+class Client:
+
+    def __init__(self,connection):
+        '''
+        One connected client. Replies may come from several device workers, so
+        sending is serialized.
+        '''
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def reply(self,request_id,opcode,strings):
+        try:
+            with self.lock:
+                self.connection.sendall(frame(request_id,opcode,strings))
+        except OSError:
+            pass
+
+class DeviceWorker:
+
+    def __init__(self,device,stats,stats_lock):
+        '''
+        Queue and worker thread for one device. stats is shared with the server and
+        the other workers, and only updated while holding stats_lock.
+        '''
+        self.device = device
+        self.stats = stats
+        self.stats_lock = stats_lock
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # (opcode, message, generation): list of (client, request id) waiting for that transaction.
+        # A transaction leaves this table when it starts, so later requests never get a reply to an earlier one.
+        self.inflight = {}
+        self.generation = 0
+        self.thread = threading.Thread(target=self.run,name='DeviceServer {:s}'.format(str(device.name)),daemon=True)
+        self.thread.start()
+
+    def submit(self,client,request_id,opcode,message):
+        '''
+        Queue a request, or attach it to an identical query waiting in the queue
+        that has not started yet.
+        '''
+        waiter = (client,request_id)
+        if opcode in (QUERY,STATUS):
+            with self.lock:
+                key = (opcode,message,self.generation)
+                if key in self.inflight:
+                    self.inflight[key].append(waiter)
+                    with self.stats_lock:
+                        self.stats['Coalesced'] += 1
+                    return
+                self.inflight[key] = [waiter]
+            self.queue.put((key,None))
+            return
+        if opcode == WRITE:
+            with self.lock:
+                self.generation += 1
+        self.queue.put(((opcode,message,None),[waiter]))
+
+    def execute(self,opcode,message):
+
+        device = self.device
+        if opcode == QUERY:
+            return [device.query(device.connection.build(message.rstrip('\r\n')))]
+        if opcode == WRITE:
+            device.write(device.connection.build(message.rstrip('\r\n')))
+            return []
+        if opcode == READ:
+            return [device.read()]
+        if opcode == STATUS:
+            device.get_status()
+            return status_strings(device.Status)
+        raise ValueError('Unknown opcode {:d}.'.format(opcode))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            key,waiters = item
+            opcode,message,_ = key
+            if waiters is None:
+                with self.lock:
+                    waiters = self.inflight.pop(key)
+            try:
+                result,code = self.execute(opcode,message),OK
+            except Exception as error:
+                result,code = ['{:s}: {:s}'.format(type(error).__name__,str(error))],ERROR
+            with self.stats_lock:
+                self.stats['Transactions'] += 1
+            for client,request_id in waiters:
+                client.reply(request_id,code,result)
+
+    def close(self):
+
+        self.queue.put(None)
+        self.thread.join()
+
+class DeviceServer:
+
+    def __init__(self,devices,path):
+        '''
+        Serve devices on a Unix socket. Call start() or serve_forever().
+
+        args:
+
+            - devices: dictionary, name:Device, or a list of Devices served under their names
+
+            - path: string, path of the Unix socket. A stale socket file is replaced.
+        '''
+        if not isinstance(devices,dict):
+            devices = {str(device.name):device for device in devices}
+        self.devices = devices
+        self.path = path
+        self.stats = {'Requests':0,'Coalesced':0,'Transactions':0}
+        self.stats_lock = threading.Lock()
+        self.workers = {name:DeviceWorker(device,self.stats,self.stats_lock) for name,device in devices.items()}
+        # connected clients, only changed while holding lock
+        self.clients = []
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.thread = None
+
+    def start(self):
+        '''
+        Accept clients in a background thread.
+        '''
+        self.thread = threading.Thread(target=self.serve_forever,name='DeviceServer {:s}'.format(self.path),daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                connection,_ = self.listener.accept()
+            except OSError:
+                return
+            client = Client(connection)
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=self.handle,args=(client,),daemon=True).start()
+
+    def handle(self,client):
+        '''
+        Read requests from one client and hand them to the device workers.
+        '''
+        try:
+            while True:
+                request_id,opcode,strings = receive_frame(client.connection)
+                with self.stats_lock:
+                    self.stats['Requests'] += 1
+                if opcode == LIST:
+                    client.reply(request_id,OK,list(self.devices))
+                    continue
+                name = strings[0] if strings else None
+                if name not in self.workers:
+                    client.reply(request_id,ERROR,['KeyError: no device named {:s}'.format(str(name))])
+                    continue
+                message = strings[1] if len(strings) > 1 else None
+                if opcode in (QUERY,WRITE) and message is None:
+                    client.reply(request_id,ERROR,['ValueError: no message to send to {:s}'.format(name)])
+                    continue
+                self.workers[name].submit(client,request_id,opcode,message)
+        except (ConnectionError,OSError,struct.error):
+            pass
+        finally:
+            client.connection.close()
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+
+    def close(self):
+        '''
+        Stop serving, let the device queues drain, and close the device connections.
+        '''
+        self.listener.close()
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for worker in self.workers.values():
+            worker.close()
+        for device in self.devices.values():
+            device.close_connection()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+class DeviceProxy:
+
+    def __init__(self,name,path):
+        '''
+        Client-side stand-in for a Device served by a DeviceServer.
+
+        args:
+
+            - name: string, name of the device on the server
+
+            - path: string, path of the server's Unix socket
+        '''
+        self.name = name
+        self.path = path
+        self.connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.connection.connect(path)
+        self.lock = threading.Lock()
+        self.request_id = 0
+        self.Status = {}
+
+    def request(self,opcode,*strings):
+        with self.lock:
+            self.request_id = (self.request_id + 1) % NONE
+            self.connection.sendall(frame(self.request_id,opcode,strings))
+            request_id,code,result = receive_frame(self.connection)
+        if request_id != self.request_id:
+            raise ConnectionError('Device server replied out of order.')
+        if code == ERROR:
+            raise RuntimeError('{:s}: {:s}'.format(str(self.name),result[0]))
+        return result
+
+    def build(self,message):
+        '''
+        Messages are built by the server for the device's own protocol, so they are sent as given.
+        '''
+        return message
+
+    def write(self,message):
+
+        self.request(WRITE,self.name,message)
+
+    def read(self):
+
+        return self.request(READ,self.name)[0]
+
+    def query(self,query_message):
+
+        return self.request(QUERY,self.name,query_message)[0]
+
+    def get_status(self):
+        '''
+        Have the server run get_status on the device and copy the result into Status.
+        '''
+        result = self.request(STATUS,self.name)
+        self.Status = dict(zip(result[0::2],result[1::2]))
+
+    def devices(self):
+        '''
+        Names of all devices on the server.
+        '''
+        return self.request(LIST)
+
+    def close(self):
+
+        self.connection.close()
+
+    def close_connection(self):
+
+        self.close()
+
+def main(argv=None):
+    import argparse
+    import time
+    from . import instrument_spec
+
+    parser = argparse.ArgumentParser(description='Serve instruments to local clients over a Unix socket.')
+    parser.add_argument('path',help='path of the Unix socket')
+    parser.add_argument('devices',nargs='+',help='name=spec[@address], e.g. supply=rp100@ASRL5')
+    parser.add_argument('--simulate',action='store_true',help='run against the simulated protocol')
+    options = parser.parse_args(argv)
+
+    devices = {}
+    for entry in options.devices:
+        name,_,spec = entry.rpartition('=')
+        spec,_,address = spec.partition('@')
+        devices[name or spec] = instrument_spec.create(spec,address or None,options.simulate)
+    with DeviceServer(devices,options.path).start():
+        print('Serving {:s} on {:s}'.format(', '.join(devices),options.path))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Exceptions raised by connections when an exchange with a device fails.
+
+Each one also derives from the matching builtin (TimeoutError or ConnectionError),
+so existing handlers keep working. Each carries the bus, the command header and
+the number of attempts made, for logging and alarms.
+'''
+
+class InstrumentError(Exception):
+
+    def __init__(self,message,bus=None,command=None,attempts=None):
+        '''
+        args:
+
+            - message: string, description of the failure
+
+            - bus: bus identifier of the connection
+
+            - command: string, header of the message being exchanged
+
+            - attempts: int, number of attempts made
+        '''
+        super().__init__(message)
+        self.bus = bus
+        self.command = command
+        self.attempts = attempts
+
+class DeviceTimeout(InstrumentError,TimeoutError):
+    '''The device did not reply in time.'''
+
+class ErrorCheckFailed(InstrumentError,ConnectionError):
+    '''The device-specific error check (e.g. handshake) following a message failed.'''
+
+class TransportError(InstrumentError,ConnectionError):
+    '''The underlying transport library raised an error; it is kept as __cause__.'''
+
+class DeviceUnavailable(InstrumentError,ConnectionError):
+    '''The device's circuit breaker is open: it failed repeatedly and is skipped until a probe succeeds.'''
+
+class ErrorReading(str):
+
+    def __new__(cls,error):
+        '''
+        Stands in for a status reading whose query failed, so that one bad command
+        does not cost the rest of a status sweep. It reads as 'ERROR: <type>', which
+        is not a number (NaN once recorded), and compares equal to the same failure
+        on the next sweep so it is reported as a change only once.
+
+        args:
+
+            - error: InstrumentError raised by the query, kept as .error
+        '''
+        reading = super().__new__(cls,'ERROR: {:s}'.format(type(error).__name__))
+        reading.error = error
+        return reading
+
+    def __getnewargs__(self):
+        return (self.error,)
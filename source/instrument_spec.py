@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Declarative instrument definitions.
+
+Instead of a Device subclass, an instrument can be described by a data file giving
+its name, communication arguments, commands and limits. TOML files are read with
+the standard library (tomli before Python 3.11); YAML files need PyYAML and JSON
+files are also accepted.
+A TOML spec looks like:
+
+    name = "RP100"
+
+    [communication]
+    Protocol = "Serial_VISA"
+    Address = "ASRL5"
+    Terminator = "\\n"
+
+    [commands]
+    "Set output voltage" = ["SOUR#:VOLT <float>", false]
+    "Query output voltage" = ["SOUR#:VOLT:NOW?", true, {Type = "float"}]
+
+    [limits]
+    Slew = [0, 10]
+
+Commands follow the same ('Command', Bool, options) structure as the command
+dictionaries of Device subclasses, with 'Type' given by name.
+
+Each file is parsed and its command templates compiled once, when the instrument
+is first asked for, into an InstrumentSpec held by the registry. Building a device
+from a spec then only copies its tables and opens the connection, and specs that
+are never used are never read, so a lab config naming hundreds of instruments
+loads quickly.
+'''
+
+import json
+import os
+import threading
+
+from . import command_template
+
+type_names = {'float':float,'int':int,'bool':bool,'str':str}
+
+extensions = ('.toml','.yaml','.yml','.json')
+
+def read_file(path):
+    '''
+    Read a spec file into a dictionary, according to its extension.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError('Reading TOML instrument specs before Python 3.11 requires tomli ({:s}).'.format(path))
+        with open(path,'rb') as file:
+            return tomllib.load(file)
+    if extension in ('.yaml','.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Reading YAML instrument specs requires PyYAML ({:s}).'.format(path))
+        with open(path) as file:
+            return yaml.safe_load(file)
+    if extension == '.json':
+        with open(path) as file:
+            return json.load(file)
+    raise ValueError('Unknown instrument spec format {:s}.'.format(path))
+
+def parse_command(name,entry):
+    '''
+    Convert one command entry to the (command, status, options) tuple used by Device.
+
+    args:
+
+        - name: string, command name, for error messages
+
+        - entry: list [command, status] or [command, status, options]
+    '''
+    if not isinstance(entry,(list,tuple)) or len(entry) not in (2,3):
+        raise ValueError('Command {:s} should be [command, status] or [command, status, options].'.format(name))
+    if len(entry) == 2:
+        return (str(entry[0]),bool(entry[1]))
+    options = dict(entry[2])
+    if isinstance(options.get('Type'),str):
+        if options['Type'] not in type_names:
+            raise ValueError('Unknown reply type {:s} for command {:s}.'.format(options['Type'],name))
+        options['Type'] = type_names[options['Type']]
+    return (str(entry[0]),bool(entry[1]),options)
+
+class InstrumentSpec:
+
+    def __init__(self,name,communication_args,commands,limits=None,source=None):
+        '''
+        Compile an instrument definition.
+
+        args:
+
+            - name: string, device identifier
+
+            - communication_args: dictionary, communication protocol specifications, as for Device
+
+            - commands: dictionary, command name:(command, status[, options])
+
+            - limits: dictionary, instrument-specific limits, made available to devices as device.limits
+
+            - source: string, path of the file the spec was read from
+        '''
+        self.name = name
+        self.communication_args = dict(communication_args)
+        self.commands = dict(commands)
+        self.limits = limits or {}
+        self.source = source
+        self.Templates = command_template.compile_commands(self.commands)
+
+    @classmethod
+    def from_dict(cls,data,source=None):
+        '''
+        Build a spec from the contents of a spec file.
+        '''
+        if 'name' not in data:
+            raise ValueError('Instrument spec {:s} has no name.'.format(str(source)))
+        commands = {name:parse_command(name,entry) for name,entry in data.get('commands',{}).items()}
+        return cls(data['name'],data.get('communication',{}),commands,data.get('limits'),source)
+
+    @classmethod
+    def from_file(cls,path):
+
+        return cls.from_dict(read_file(path),path)
+
+    def connection_args(self,address=None,**communication_args):
+        '''
+        Communication arguments for one device, with the address and any other arguments overridden.
+        '''
+        args = dict(self.communication_args,**communication_args)
+        if address is not None:
+            args['Address'] = address
+        return args
+
+    def build(self,address=None,simulate=False,**communication_args):
+        '''
+        Create a Device for this instrument and open its connection.
+
+        args:
+
+            - address: string, device address. Defaults to the address in the spec.
+
+            - simulate: bool, run against the simulated protocol instead of hardware
+
+            - communication_args: further communication arguments overriding the spec
+
+        return:
+
+            - device: Device instance
+        '''
+        from . import device
+        instrument = device.Device()
+        instrument.simulate = simulate or instrument.simulate
+        instrument.initialize_spec(self,address,**communication_args)
+        return instrument
+
+class Registry:
+
+    def __init__(self,paths=()):
+        '''
+        Registry of instrument specs found in a set of directories. Directories are
+        only listed, and files only read, when a spec is first looked up.
+
+        args:
+
+            - paths: iterable of directory paths holding spec files
+        '''
+        self.paths = list(paths)
+        self.files = None
+        self.specs = {}
+        self.lock = threading.RLock()
+
+    def add_path(self,path):
+        '''
+        Add a directory of spec files. Specs there take precedence over earlier directories.
+        '''
+        with self.lock:
+            self.paths.append(path)
+            self.files = None
+
+    def scan(self):
+        '''
+        List the spec files available, as lower-case file name:path.
+        '''
+        with self.lock:
+            if self.files is None:
+                files = {}
+                for path in self.paths:
+                    if not os.path.isdir(path):
+                        continue
+                    for entry in os.scandir(path):
+                        stem,extension = os.path.splitext(entry.name)
+                        if extension.lower() in extensions and entry.is_file():
+                            files[stem.lower()] = entry.path
+                self.files = files
+            return self.files
+
+    def names(self):
+        '''
+        Names under which specs can be looked up.
+        '''
+        return sorted(self.scan())
+
+    def register(self,spec,key=None):
+        '''
+        Add an already compiled spec, e.g. one defined in code.
+        '''
+        with self.lock:
+            self.specs[(key or spec.name).lower()] = spec
+
+    def get(self,name):
+        '''
+        Look up a spec by file name or instrument name (case-insensitive), reading
+        and compiling it on first use. A file name only needs that one file read.
+        A name that matches no file makes the registry read the specs not loaded yet,
+        to find the file declaring that instrument name.
+
+        return:
+
+            - spec: InstrumentSpec
+        '''
+        key = name.lower()
+        spec = self.specs.get(key)
+        if spec is not None:
+            return spec
+        with self.lock:
+            if key not in self.specs:
+                files = self.scan()
+                if key in files:
+                    self.load(key,files[key])
+                else:
+                    for stem,path in files.items():
+                        if stem not in self.specs:
+                            self.load(stem,path)
+                        if key in self.specs:
+                            break
+                if key not in self.specs:
+                    raise KeyError('No instrument spec named {:s}. Available: {:s}.'.format(name,', '.join(self.names())))
+            return self.specs[key]
+
+    def load(self,stem,path):
+        '''
+        Read one spec file, registering it under its file name and its instrument name.
+        '''
+        spec = InstrumentSpec.from_file(path)
+        self.specs[stem] = spec
+        self.specs.setdefault(spec.name.lower(),spec)
+        return spec
+
+    def create(self,name,address=None,simulate=False,**communication_args):
+        '''
+        Create a Device from a registered spec; see InstrumentSpec.build.
+        '''
+        return self.get(name).build(address,simulate,**communication_args)
+
+# specs shipped with the library
+registry = Registry([os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'instruments','specs')])
+
+def create(name,address=None,simulate=False,**communication_args):
+    '''
+    Create a Device from a spec in the shared registry.
+    '''
+    return registry.create(name,address,simulate,**communication_args)
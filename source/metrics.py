@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Optional metrics for the connection classes.
+
+A connection records nothing until a Metrics instance is attached to it
+(Device.enable_metrics). While detached, the cost is one attribute check per call.
+Once attached, it records:
+
+    - per-command timing histograms, including the handshake step of the RS232 error check
+    - retries, empty replies and exceptions that the connection swallows
+    - exchanges that failed every attempt, circuit-breaker trips and calls skipped while a breaker is open
+    - bytes written to and read from the bus
+
+snapshot() returns plain dictionaries and export_prometheus() the Prometheus text exposition format.
+'''
+
+import threading
+
+# upper bounds of the histogram buckets, in seconds
+default_buckets = (0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+counter_names = ('retries','empty_replies','swallowed_exceptions','bytes_out','bytes_in','reconnects','failures','breaker_trips','skipped')
+
+def command_label(message):
+    '''
+    Label for a message in the timing histograms: its header, without arguments or termination.
+    '''
+    if isinstance(message,bytes):
+        message = message.decode('utf-8','replace')
+    return message.strip().split(' ')[0]
+
+def escape(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+class Metrics:
+
+    def __init__(self,buckets=default_buckets):
+        '''
+        Create an empty metrics registry. One registry can be shared by many connections;
+        entries are labelled by each connection's metrics_label: its bus, or the VISA resource.
+
+        args:
+
+            - buckets: tuple of floats, histogram bucket upper bounds in seconds
+        '''
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clear all recorded values.
+        '''
+        with self.lock:
+            self.histograms = {}
+            self.counters = {name:{} for name in counter_names}
+            self.exceptions = {}
+
+    def observe(self,bus,command,seconds):
+        '''
+        Record the duration of one command.
+
+        args:
+
+            - bus: connection label
+
+            - command: string, command label
+
+            - seconds: float
+        '''
+        key = (str(bus),command)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0]*len(self.buckets),0.0,0]
+            for index,bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def count(self,name,bus,amount=1):
+        '''
+        Add to one of the counters in counter_names.
+        '''
+        with self.lock:
+            counter = self.counters[name]
+            counter[str(bus)] = counter.get(str(bus),0) + amount
+
+    def swallowed(self,bus,error):
+        '''
+        Record an exception that a connection caught and turned into an empty reply.
+        '''
+        key = (str(bus),type(error).__name__)
+        with self.lock:
+            counter = self.counters['swallowed_exceptions']
+            counter[key[0]] = counter.get(key[0],0) + 1
+            self.exceptions[key] = self.exceptions.get(key,0) + 1
+
+    def snapshot(self):
+        '''
+        Copy of the current values.
+
+        return:
+
+            - snapshot: dictionary with keys
+                'Commands': dictionary, (bus, command):{'count', 'sum', 'mean', 'buckets'}, buckets being cumulative (bound, count) pairs
+                'Counters': dictionary, counter name:{bus:value}
+                'Exceptions': dictionary, (bus, exception type):count
+        '''
+        with self.lock:
+            commands = {}
+            for key,(counts,total,count) in self.histograms.items():
+                cumulative = []
+                running = 0
+                for bound,value in zip(self.buckets,counts):
+                    running += value
+                    cumulative.append((bound,running))
+                commands[key] = {'count':count,'sum':total,'mean':total/count if count else 0.0,'buckets':cumulative}
+            return {'Commands':commands,
+                    'Counters':{name:dict(values) for name,values in self.counters.items()},
+                    'Exceptions':dict(self.exceptions)}
+
+    def export_prometheus(self,prefix='instrument'):
+        '''
+        Render the current values in the Prometheus text exposition format.
+
+        args:
+
+            - prefix: string, prefix of every metric name
+
+        return:
+
+            - text: string
+        '''
+        snapshot = self.snapshot()
+        lines = ['# HELP {:s}_command_seconds Time spent per command on the bus.'.format(prefix),
+                 '# TYPE {:s}_command_seconds histogram'.format(prefix)]
+        for (bus,command),values in sorted(snapshot['Commands'].items()):
+            labels = 'bus="{:s}",command="{:s}"'.format(escape(bus),escape(command))
+            for bound,count in values['buckets']:
+                lines.append('{:s}_command_seconds_bucket{{{:s},le="{:g}"}} {:d}'.format(prefix,labels,bound,count))
+            lines.append('{:s}_command_seconds_bucket{{{:s},le="+Inf"}} {:d}'.format(prefix,labels,values['count']))
+            lines.append('{:s}_command_seconds_sum{{{:s}}} {:.9g}'.format(prefix,labels,values['sum']))
+            lines.append('{:s}_command_seconds_count{{{:s}}} {:d}'.format(prefix,labels,values['count']))
+
+        for name in counter_names:
+            lines.append('# TYPE {:s}_{:s}_total counter'.format(prefix,name))
+            for bus,value in sorted(snapshot['Counters'][name].items()):
+                lines.append('{:s}_{:s}_total{{bus="{:s}"}} {:d}'.format(prefix,name,escape(bus),value))
+
+        lines.append('# TYPE {:s}_swallowed_exceptions_by_type_total counter'.format(prefix))
+        for (bus,kind),value in sorted(snapshot['Exceptions'].items()):
+            lines.append('{:s}_swallowed_exceptions_by_type_total{{bus="{:s}",type="{:s}"}} {:d}'.format(prefix,escape(bus),escape(kind),value))
+        return '\n'.join(lines) + '\n'
+
+registry = Metrics()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Concurrent status polling for a collection of devices.
+
+Devices are grouped by the physical bus they sit on (serial port, GPIB board, ...).
+Each bus is polled by its own worker thread, so devices on the same bus are still
+queried one after another, in order, while independent buses run in parallel. A
+full sweep then costs about as much as the slowest bus rather than the sum of all.
+'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def bus_key(device):
+    '''
+    Identify the physical bus a device communicates over. Devices whose connection
+    does not report a bus are treated as sitting on a bus of their own.
+
+    args:
+
+        - device: Device instance
+
+    return:
+
+        - key: hashable bus identifier
+    '''
+    bus = getattr(device.connection,'bus',None)
+    if bus is None:
+        return ('device',id(device))
+    return bus
+
+class StatusPoller:
+
+    def __init__(self,devices,max_workers=None):
+        '''
+        Set up a poller over a set of devices.
+
+        args:
+
+            - devices: iterable of Device instances
+
+            - max_workers: int, number of worker threads. Defaults to one per bus.
+        '''
+        self.devices = list(devices)
+        self.buses = {}
+        for device in self.devices:
+            self.buses.setdefault(bus_key(device),[]).append(device)
+        if max_workers is None:
+            max_workers = max(len(self.buses),1)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix='StatusPoller')
+        self.Timing = {}
+        self.board = None
+        # record number of each device on the status board
+        self.slots = {device:number for number,device in enumerate(self.devices)}
+
+    def poll_bus(self,devices):
+        '''
+        Update the status of each device on one bus, in order.
+
+        args:
+
+            - devices: list of Device instances sharing a bus
+
+        return:
+
+            - timing: dictionary, Device:cycle time in seconds
+
+            - errors: dictionary, Device:exception raised while polling
+        '''
+        timing = {}
+        errors = {}
+        for device in devices:
+            start = time.perf_counter()
+            try:
+                device.get_status()
+                if self.board is not None:
+                    self.board.publish(self.slots[device],device.Status,device.StatusTimestamp)
+                failing = getattr(device,'StatusErrors',None)
+                if failing:
+                    errors[device] = next(iter(failing.values()))
+            except Exception as error:
+                errors[device] = error
+            timing[device] = time.perf_counter() - start
+        return timing,errors
+
+    def poll(self):
+        '''
+        Run one status sweep over every device. Each device's Status dictionary is
+        filled in as usual; a failure on one device is recorded and does not stop the others.
+
+        return:
+
+            - Timing: dictionary with keys
+                'Cycle': float, wall-clock time of the whole sweep in seconds
+                'Buses': dictionary, bus:time spent polling that bus
+                'Devices': dictionary, Device:time spent on that device
+                'Errors': dictionary, Device:exception, for devices that failed or have a status command failing
+
+            Devices are keyed by instance, since several may share a name.
+        '''
+        start = time.perf_counter()
+        futures = {bus:self.executor.submit(self.poll_bus,devices) for bus,devices in self.buses.items()}
+        timing = {'Cycle':0.0,'Buses':{},'Devices':{},'Errors':{}}
+        for bus,future in futures.items():
+            devices,errors = future.result()
+            timing['Buses'][bus] = sum(devices.values())
+            timing['Devices'].update(devices)
+            timing['Errors'].update(errors)
+        timing['Cycle'] = time.perf_counter() - start
+        self.Timing = timing
+        return timing
+
+    def enable_status_board(self,name=None):
+        '''
+        Publish every device's status to a shared memory StatusBoard after each poll,
+        so that other local processes can read the latest values without touching
+        the bus (see status_board). Requires numpy.
+
+        args:
+
+            - name: string, name of the shared memory segment. A fresh name is chosen if None.
+
+        return:
+
+            - board: StatusBoard; readers attach with StatusBoard(board.name)
+        '''
+        from . import status_board
+        self.disable_status_board()
+        self.board = status_board.StatusBoard.for_devices(self.devices,name)
+        return self.board
+
+    def disable_status_board(self):
+        '''
+        Stop publishing and remove the shared memory segment.
+        '''
+        if self.board is not None:
+            self.board.close()
+            self.board = None
+
+    def print_timing(self):
+        '''
+        Print summary of the last sweep: per-bus and per-device cost against the total cycle time.
+        '''
+        if not self.Timing:
+            print('No sweep has been run yet.')
+            return
+        lines = ['| cycle | {:.1f} ms |'.format(1e3*self.Timing['Cycle'])]
+        lines += ['| bus {:s} | {:.1f} ms |'.format(str(bus),1e3*cost) for bus,cost in self.Timing['Buses'].items()]
+        lines += ['| {:s} | {:.1f} ms |'.format(str(device.name),1e3*cost) for device,cost in self.Timing['Devices'].items()]
+        print('\n'.join(lines))
+
+    def close(self):
+        '''
+        Stop the worker threads and remove the status board, if any. Device connections are left open.
+        '''
+        self.executor.shutdown(wait=True)
+        self.disable_status_board()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Read-through cache for slow-changing queries.
+
+Commands opt in with a 'TTL' option in the command dictionary, in seconds:
+
+    'Query voltage slew rate':('SOUR#:VOLT:SLEW?', False, {'TTL':60})
+
+A reply to such a query is reused until its TTL expires. Writes invalidate the
+cached replies they may affect. Each setter automatically covers the query with
+the same header ('SOUR#:VOLT:SLEW <float>' covers 'SOUR#:VOLT:SLEW?') on the same
+channel, and further queries can be listed with an 'Invalidates' option on the
+setter. A write that cannot be matched to a known setter, or an argument-less
+command such as *RST, clears the whole cache.
+'''
+
+import threading
+import time
+
+class QueryCache:
+
+    def __init__(self,Templates):
+        '''
+        Build the cache rules from a device's compiled command templates.
+
+        args:
+
+            - Templates: dictionary, command name:CommandTemplate, as Device.Templates
+        '''
+        self.Templates = Templates
+        self.ttls = {name:template.options['TTL'] for name,template in Templates.items()
+                     if template.is_query and template.options.get('TTL')}
+
+        queries = {template.header[:-1]:name for name,template in Templates.items() if template.is_query}
+        self.invalidates = {}
+        for name,template in Templates.items():
+            if template.is_query or not template.arguments:
+                continue
+            related = list(template.options.get('Invalidates',[]))
+            if template.header in queries:
+                related.append(queries[template.header])
+            self.invalidates[name] = [query for query in related if query in self.ttls]
+
+        self.headers = {}
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stats = {'Hits':0,'Misses':0,'Invalidations':0}
+        self.CommandStats = {name:{'Hits':0,'Misses':0} for name in self.ttls}
+
+    def resolve(self,header):
+        '''
+        Find the command a message header belongs to. Results are memoized per header.
+
+        return:
+
+            - (name, channel), or None if no template matches
+        '''
+        if header in self.headers:
+            return self.headers[header]
+        resolved = None
+        for name,template in self.Templates.items():
+            channel = template.match(header)
+            if channel is not False:
+                resolved = (name,channel)
+                break
+        self.headers[header] = resolved
+        return resolved
+
+    def parts(self,message):
+        '''
+        Split a message into (header, is query) pairs, one per ';'-separated part.
+        '''
+        if isinstance(message,bytes):
+            message = message.decode('utf-8','replace')
+        return [(part.strip().lstrip(':').split(' ')[0],part.strip().split(' ')[0].endswith('?')) for part in message.strip().split(';')]
+
+    def key(self,message):
+        if isinstance(message,bytes):
+            message = message.decode('utf-8','replace')
+        return message.strip()
+
+    def get(self,message):
+        '''
+        Look up a cached reply.
+
+        args:
+
+            - message: string or bytes, query as sent to the device
+
+        return:
+
+            - (hit, reply): hit is True if reply came from the cache
+        '''
+        parts = self.parts(message)
+        if not all(is_query for _,is_query in parts):
+            self.invalidate(message)
+            return False,None
+        key = self.key(message)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.stats['Hits'] += 1
+                self.CommandStats[entry[2]]['Hits'] += 1
+                return True,entry[1]
+            self.stats['Misses'] += 1
+            if len(parts) == 1:
+                resolved = self.resolve(parts[0][0])
+                if resolved is not None and resolved[0] in self.CommandStats:
+                    self.CommandStats[resolved[0]]['Misses'] += 1
+        return False,None
+
+    def put(self,message,reply):
+        '''
+        Store a reply if its query has a TTL. Empty replies (failed queries) are not stored.
+        '''
+        parts = self.parts(message)
+        if not reply or len(parts) != 1 or not parts[0][1]:
+            return
+        resolved = self.resolve(parts[0][0])
+        if resolved is None or resolved[0] not in self.ttls:
+            return
+        with self.lock:
+            self.entries[self.key(message)] = (time.monotonic() + self.ttls[resolved[0]],reply,resolved[0],resolved[1])
+
+    def invalidate(self,message):
+        '''
+        Drop the cached replies a written message may affect.
+
+        args:
+
+            - message: string or bytes, as sent to the device
+        '''
+        if not self.entries:
+            return
+        for header,is_query in self.parts(message):
+            if is_query:
+                continue
+            resolved = self.resolve(header)
+            if resolved is None or resolved[0] not in self.invalidates:
+                self.clear()
+                return
+            name,channel = resolved
+            affected = self.invalidates[name]
+            if not affected:
+                continue
+            with self.lock:
+                for key in [key for key,entry in self.entries.items() if entry[2] in affected and (channel == entry[3] or None in (channel,entry[3]))]:
+                    del self.entries[key]
+                    self.stats['Invalidations'] += 1
+
+    def clear(self):
+        '''
+        Drop every cached reply.
+        '''
+        with self.lock:
+            self.stats['Invalidations'] += len(self.entries)
+            self.entries.clear()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Retry, timeout and circuit-breaker policy for exchanges with devices.
+
+Every transport runs its exchanges through its own RetryPolicy (Transport.policy). A failed exchange is tried again up to a number of attempts, with
+exponential backoff and random jitter between attempts so that devices sharing a
+bus do not retry in lockstep. Each command can have its own timeout. When the
+attempts run out, a structured error from errors is raised rather than an empty
+reply, unless the policy is set to return empty replies as before.
+
+A CircuitBreaker on a connection (see Device.enable_circuit_breaker) counts
+consecutive failures. Once it trips, calls fail at once with DeviceUnavailable
+instead of waiting out timeouts, so one unplugged device cannot stall a poll
+cycle. A background thread probes the device periodically and closes the breaker
+again once a probe succeeds.
+'''
+
+import random
+import threading
+import time
+
+from . import errors
+from . import metrics as metrics_module
+from .command_template import CommandTemplate
+
+class RetryPolicy:
+
+    def __init__(self,attempts=3,backoff=0.05,max_backoff=1.0,jitter=0.5,timeouts=None,retry_on=(OSError,),raise_errors=True):
+        '''
+        args:
+
+            - attempts: int, attempts per exchange, including the first
+
+            - backoff: float, seconds before the second attempt, doubling for each one after
+
+            - max_backoff: float, longest wait between attempts
+
+            - jitter: float, fraction of each wait that is randomized (0 for none)
+
+            - timeouts: dictionary, command header:seconds, e.g. {'MEAS#:VOLT?':0.2}. '#' matches a channel number.
+            Other commands use the connection's Timeout.
+
+            - retry_on: tuple of exception types that are worth another attempt. DeviceTimeout, ErrorCheckFailed
+            and TransportError are all OSErrors.
+
+            - raise_errors: bool. If False, an exchange that fails every attempt returns an empty string, as
+            connections did before, and the error is only recorded in the metrics.
+        '''
+        self.attempts = max(1,attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = retry_on
+        self.raise_errors = raise_errors
+        self.random = random.Random()
+        self.set_timeouts(timeouts or {})
+
+    def set_timeouts(self,timeouts):
+
+        self.timeouts = dict(timeouts)
+        self.timeout_templates = [(CommandTemplate(header),seconds) for header,seconds in self.timeouts.items()]
+        self.resolved = {}
+
+    def with_timeouts(self,timeouts):
+        '''
+        Copy of this policy with further per-command timeouts.
+        '''
+        policy = RetryPolicy(self.attempts,self.backoff,self.max_backoff,self.jitter,dict(self.timeouts,**timeouts),self.retry_on,self.raise_errors)
+        return policy
+
+    def delay(self,attempt):
+        '''
+        Seconds to wait after a failed attempt (1 for the first).
+        '''
+        wait = min(self.max_backoff,self.backoff*2**(attempt-1))
+        return wait*(1.0 - self.jitter*self.random.random())
+
+    def budget(self,timeout):
+        '''
+        Longest an exchange can take under this policy: every attempt running out of
+        timeout, plus the longest backoff between attempts. None if timeout is None.
+        '''
+        if timeout is None:
+            return None
+        return self.attempts*timeout + sum(min(self.max_backoff,self.backoff*2**(attempt-1)) for attempt in range(1,self.attempts))
+
+    def timeout_for(self,header,default):
+        '''
+        Timeout for a message header; memoized per header. A compound header
+        ('A?;B?') gets the longest timeout of its parts.
+        '''
+        key = (header,default)
+        if key not in self.resolved:
+            timeouts = []
+            for part in header.split(';'):
+                part = part.lstrip(':')
+                for template,seconds in self.timeout_templates:
+                    if template.match(part) is not False:
+                        timeouts.append(seconds)
+                        break
+                else:
+                    timeouts.append(default)
+            known = [timeout for timeout in timeouts if timeout is not None]
+            self.resolved[key] = max(known) if known else None
+        return self.resolved[key]
+
+    def run(self,connection,message,function,retry=True):
+        '''
+        Run one exchange under this policy.
+
+        args:
+
+            - connection: transport running the exchange; its bus, timeout, metrics and breaker are used
+
+            - message: string or bytes, the message exchanged, used to pick the timeout and label errors
+
+            - function: callable(timeout) doing one attempt. It raises on failure, e.g. DeviceTimeout on an empty reply.
+
+            - retry: bool, False for exchanges that must not be repeated, such as a bare read
+
+        return:
+
+            - return value of function, or an empty string if every attempt failed and raise_errors is False
+        '''
+        header = metrics_module.command_label(message).lstrip(':')
+        breaker = connection.breaker
+        metrics = connection.metrics
+        if breaker is not None and not breaker.allow():
+            error = errors.DeviceUnavailable('{:s} is marked unavailable after repeated failures.'.format(str(connection.bus)),connection.bus,header,0)
+            return self.fail(connection,error,'skipped')
+
+        timeout = self.timeout_for(header,connection.timeout)
+        attempts = self.attempts if retry else 1
+        try:
+            for attempt in range(1,attempts+1):
+                try:
+                    result = function(timeout)
+                except self.retry_on as error:
+                    last = error
+                    if attempt < attempts:
+                        if metrics is not None:
+                            metrics.count('retries',connection.metrics_label)
+                        time.sleep(self.delay(attempt))
+                    continue
+                if breaker is not None:
+                    breaker.success()
+                return result
+        except BaseException:
+            # any other error, e.g. a reply that cannot be decoded, still counts against the
+            # breaker, so that a half-open trial always ends
+            if breaker is not None:
+                breaker.failure(connection)
+            raise
+
+        if breaker is not None:
+            breaker.failure(connection)
+        if isinstance(last,errors.InstrumentError):
+            last.attempts = attempts
+            last.command = last.command or header
+            error = last
+        else:
+            error = errors.TransportError('{:s} failed on {:s}: {:s}'.format(header,str(connection.bus),str(last)),connection.bus,header,attempts)
+            error.__cause__ = last
+        return self.fail(connection,error)
+
+    def fail(self,connection,error,counter='failures'):
+        '''
+        Raise error, or return an empty string if raise_errors is False.
+        '''
+        if self.raise_errors:
+            if connection.metrics is not None:
+                connection.metrics.count(counter,connection.metrics_label)
+            raise error
+        if connection.metrics is not None:
+            connection.metrics.swallowed(connection.metrics_label,error)
+        return ''
+
+class CircuitBreaker:
+
+    def __init__(self,threshold=3,probe_interval=5.0,probe=None):
+        '''
+        args:
+
+            - threshold: int, consecutive failed exchanges that trip the breaker
+
+            - probe_interval: float, seconds between probes while tripped
+
+            - probe: callable() exchanging something harmless with the device, raising if it fails.
+            If None, the next real call after each interval is let through as the probe.
+        '''
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.probe = probe
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self.trial = False
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def allow(self):
+        '''
+        Whether an exchange may go ahead: always while closed, never while open.
+        While half-open only the first caller (normally the probe) goes through as
+        the trial; the others are refused until it has succeeded or failed.
+        '''
+        if self.state == 'closed':
+            return True
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+
+        with self.lock:
+            self.failures = 0
+            self.state = 'closed'
+            self.trial = False
+
+    def failure(self,connection=None):
+        '''
+        Count a failed exchange, tripping the breaker at the threshold or when a probe fails.
+        '''
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+                if self.state == 'closed':
+                    self.trips += 1
+                    if connection is not None and connection.metrics is not None:
+                        connection.metrics.count('breaker_trips',connection.metrics_label)
+                self.state = 'open'
+                self.trial = False
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run_probes,name='CircuitBreaker probe',daemon=True)
+                    self.thread.start()
+
+    def run_probes(self):
+        # runs until the breaker closes: a trial let through while half-open may end without closing it
+        while not self.stopping.wait(self.probe_interval):
+            with self.lock:
+                if self.state == 'closed':
+                    # cleared under the lock, so a failure from now on starts a new thread
+                    self.thread = None
+                    return
+                if self.state == 'open':
+                    self.state = 'half-open'
+            if self.probe is None:
+                continue
+            try:
+                self.probe()
+            except Exception:
+                pass
+
+    def is_healthy(self):
+
+        return self.state == 'closed'
+
+    def close(self):
+        '''
+        Stop probing.
+        '''
+        self.stopping.set()
+        thread = self.thread
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Polling scheduler: each status command at its own rate.
+
+get_status reads every status command of a device at once. The PollScheduler
+instead polls each status command on its own period, given by a 'Period' option
+in the command dictionary (seconds), and a 'Priority' option (higher first,
+default 0) to order commands whose deadlines coincide:
+
+    'Query temperature':('TEMP?', True, {'Period':60}),
+    'Measure output voltage':('MEAS#:VOLT?', True, {'Period':0.1, 'Priority':1}),
+
+Commands without a 'Period' use the scheduler's default period. Each bus is served
+by its own thread. Whenever the bus is free, the thread takes the due command
+with the earliest deadline (due time plus period), the highest priority first
+among equal deadlines. Earliest deadline first keeps every command polled when a
+bus is overloaded: each slows down in proportion, and none is starved. On devices
+with compound queries, other due commands of the same device ride along in the
+same message, in deadline order. A bus with a 'MaxRate' communication argument
+(transactions per second) is never driven faster than that, which keeps slow
+RS232 lines from saturating.
+
+utilization() reports each bus's load: transactions per second against MaxRate,
+the fraction of time the bus was busy, the query rate the periods ask for, and
+the number of deadlines missed.
+'''
+
+import datetime as dt
+import threading
+import time
+
+from . import errors
+from .poller import bus_key
+
+class Task:
+
+    def __init__(self,device,command,period,priority):
+        '''
+        One status command polled on its own period.
+        '''
+        self.device = device
+        self.command = command
+        self.period = period
+        self.priority = priority
+        self.due = time.monotonic()
+        self.missed = 0
+
+    def urgency(self):
+        '''
+        Sort key: earliest deadline first, then highest priority.
+        '''
+        return (self.due + self.period,-self.priority)
+
+class BusSchedule:
+
+    def __init__(self,bus,tasks,max_rate=None):
+        '''
+        The tasks of one bus, with their rate limit and load counters.
+        '''
+        self.bus = bus
+        self.tasks = tasks
+        self.max_rate = max_rate
+        self.next_slot = 0.0
+        self.transactions = 0
+        self.busy = 0.0
+        self.started = time.monotonic()
+        self.errors = {}
+
+    def batch(self,now):
+        '''
+        Pick the next transaction: the most urgent due task, plus any other due tasks
+        of the same device that fit in one compound message.
+
+        return:
+
+            - tasks: list of Task, empty if nothing is due
+        '''
+        due = sorted([task for task in self.tasks if task.due <= now],key=Task.urgency)
+        if not due:
+            return []
+        first = due[0]
+        device = first.device
+        batch = [first]
+        if device.compound_queries:
+            size = len(device.StatusCommands[first.command]) + 2
+            for task in due[1:]:
+                if task.device is device:
+                    extra = len(device.StatusCommands[task.command]) + 2
+                    if size + extra <= device.max_message_length:
+                        batch.append(task)
+                        size += extra
+        return batch
+
+    def next_due(self):
+
+        return min(task.due for task in self.tasks)
+
+    def run_batch(self,batch):
+        '''
+        Query one batch and update the device's Status. The bus lock is held for the
+        whole batch, including any fallback to one query per command, and every
+        exchange sent counts as a transaction against MaxRate.
+        '''
+        device = batch[0].device
+        start = time.monotonic()
+        sent = device.exchanges
+        try:
+            with device.lock:
+                readings = device.query_status_batch([task.command for task in batch])
+                device.StatusTimestamp = time.time_ns()
+                device.Status['DateTime'] = dt.datetime.now().strftime('%H:%M:%S %d/%m/%y')
+            device.update_status(readings)
+            failed = [reading.error for reading in readings.values() if isinstance(reading,errors.ErrorReading)]
+            if failed:
+                self.errors[device] = failed[0]
+            else:
+                self.errors.pop(device,None)
+        except Exception as error:
+            self.errors[device] = error
+        end = time.monotonic()
+        sent = device.exchanges - sent
+        self.transactions += sent
+        self.busy += end - start
+        if self.max_rate:
+            self.next_slot = start + sent/self.max_rate
+        for task in batch:
+            if end > task.due + task.period:
+                task.missed += 1
+            # the next release is one period on, or now if the bus has fallen that far behind
+            task.due = max(task.due + task.period,end)
+
+    def utilization(self):
+        '''
+        Load of this bus since the scheduler started.
+        '''
+        elapsed = max(time.monotonic() - self.started,1e-9)
+        rate = self.transactions/elapsed
+        return {'Transactions':self.transactions,
+                'Rate':rate,
+                'MaxRate':self.max_rate,
+                'RateUtilization':rate/self.max_rate if self.max_rate else None,
+                'BusyFraction':self.busy/elapsed,
+                'Demand':sum(1.0/task.period for task in self.tasks),
+                'Missed':sum(task.missed for task in self.tasks),
+                'Errors':dict(self.errors)}
+
+class PollScheduler:
+
+    def __init__(self,devices,default_period=1.0,max_rates=None):
+        '''
+        Set up per-command polling of a set of devices. Call start() to begin.
+
+        args:
+
+            - devices: iterable of Device instances
+
+            - default_period: float, seconds between polls of status commands without a 'Period' option
+
+            - max_rates: dictionary, bus:transactions per second, overriding the devices' 'MaxRate' arguments
+        '''
+        self.devices = list(devices)
+        max_rates = max_rates or {}
+        tasks = {}
+        rates = {}
+        for device in self.devices:
+            bus = bus_key(device)
+            for command in device.StatusCommands:
+                options = device.Templates[command].options
+                tasks.setdefault(bus,[]).append(Task(device,command,options.get('Period',default_period),options.get('Priority',0)))
+            if device.max_rate is not None:
+                rates[bus] = min(rates.get(bus,device.max_rate),device.max_rate)
+        rates.update(max_rates)
+        self.buses = {bus:BusSchedule(bus,bus_tasks,rates.get(bus)) for bus,bus_tasks in tasks.items()}
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def run(self,schedule):
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            wait = max(schedule.next_slot,schedule.next_due()) - now
+            if wait > 0:
+                self.stopping.wait(wait)
+                continue
+            schedule.run_batch(schedule.batch(now))
+
+    def start(self):
+        '''
+        Start one polling thread per bus.
+        '''
+        if self.threads:
+            return self
+        self.stopping.clear()
+        now = time.monotonic()
+        for schedule in self.buses.values():
+            schedule.started = now
+            for task in schedule.tasks:
+                task.due = now
+            thread = threading.Thread(target=self.run,args=(schedule,),name='PollScheduler {:s}'.format(str(schedule.bus)),daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        '''
+        Stop polling, waiting for transactions in progress to finish.
+        '''
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def utilization(self):
+        '''
+        Load of every bus.
+
+        return:
+
+            - dictionary, bus:dictionary with keys
+                'Transactions': int, transactions since start
+                'Rate': float, transactions per second
+                'MaxRate': float or None, rate limit of the bus
+                'RateUtilization': float or None, Rate/MaxRate
+                'BusyFraction': float, fraction of time spent in transactions
+                'Demand': float, queries per second asked for by the command periods
+                'Missed': int, polls that finished after their deadline
+                'Errors': dictionary, Device:last exception, for devices currently failing
+        '''
+        return {bus:schedule.utilization() for bus,schedule in self.buses.items()}
+
+    def print_utilization(self):
+        '''
+        Print summary of utilization() per bus.
+        '''
+        lines = []
+        for bus,load in self.utilization().items():
+            line = '| bus {:s} | {:.1f} tr/s'.format(str(bus),load['Rate'])
+            if load['MaxRate']:
+                line += ' of {:.1f} ({:.0%})'.format(load['MaxRate'],load['RateUtilization'])
+            line += ' | busy {:.0%} | demand {:.1f} q/s | missed {:d} |'.format(load['BusyFraction'],load['Demand'],load['Missed'])
+            lines.append(line)
+        print('\n'.join(lines))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*exc_info):
+        self.stop()
@@ -5,7 +5,13 @@ Created on Mon Jun 29 17:16:58 2020
 
 @author: ryanday
 """
+import threading
+import time
+import weakref
 import serial
+from . import errors
+from . import metrics as metrics_module
+from . import transport
 
 bytesize_dict = {5:serial.FIVEBITS,
                  6:serial.SIXBITS,
@@ -22,7 +28,274 @@ stop_dict = {1:serial.STOPBITS_ONE,
              1.5:serial.STOPBITS_ONE_POINT_FIVE,
              2:serial.STOPBITS_TWO}
 
-class RS232:
+_sessions = {}
+_sessions_lock = threading.Lock()
+_readers = weakref.WeakKeyDictionary()
+
+class FrameReader:
+
+    def __init__(self,separator=b'\n',chunk_size=4096):
+        '''
+        Incremental frame splitter for one open port. Bytes are read in chunks
+        (whatever has arrived, up to chunk_size) rather than one at a time, split on
+        the separator, and anything after the last complete frame is kept for the
+        next call.
+
+        args:
+
+            - separator: bytes, end of a frame
+
+            - chunk_size: int, largest single read from the port
+        '''
+        self.separator = separator
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.start = 0
+        self.scanned = 0
+
+    def fill(self,connection):
+        '''
+        Read one chunk: everything waiting on the port, or block for the first
+        byte up to the port timeout.
+
+        return:
+
+            - count: int, number of bytes read, 0 on timeout
+        '''
+        data = connection.read(max(1,min(connection.in_waiting,self.chunk_size)))
+        if self.start and self.start == len(self.buffer):
+            del self.buffer[:]
+            self.start = self.scanned = 0
+        self.buffer += data
+        return len(data)
+
+    def pop(self):
+        '''
+        Take the next complete frame out of the buffer, terminator included.
+
+        return:
+
+            - frame: bytes, or None if no complete frame has arrived
+        '''
+        index = self.buffer.find(self.separator,max(self.start,self.scanned))
+        if index < 0:
+            self.scanned = max(len(self.buffer) - len(self.separator) + 1,self.start)
+            return None
+        end = index + len(self.separator)
+        frame = bytes(self.buffer[self.start:end])
+        self.start = end
+        if self.start > self.chunk_size and 2*self.start > len(self.buffer):
+            del self.buffer[:self.start]
+            self.start = self.scanned = 0
+        return frame
+
+    def clear(self):
+        '''
+        Drop everything buffered, e.g. a late reply to an attempt that timed out.
+        '''
+        del self.buffer[:]
+        self.start = self.scanned = 0
+
+    def take(self,count):
+        '''
+        Take up to count buffered bytes, whether or not they form a frame.
+        '''
+        data = bytes(self.buffer[self.start:self.start+count])
+        self.start += len(data)
+        return data
+
+    def next_frame(self,connection):
+        '''
+        Return the next frame, reading chunks from the port as needed. If the port
+        times out first, whatever partial frame has arrived is returned instead
+        (possibly empty), as readline() would.
+
+        args:
+
+            - connection: open pyserial Serial instance
+
+        return:
+
+            - frame: bytes
+        '''
+        while True:
+            frame = self.pop()
+            if frame is not None:
+                return frame
+            if not self.fill(connection):
+                return self.take(len(self.buffer))
+
+    def frames(self,connection):
+        '''
+        Read one chunk and return every frame it completes.
+
+        return:
+
+            - frames: list of bytes, or None if the port timed out with nothing new
+        '''
+        if not self.fill(connection):
+            return None
+        frames = []
+        frame = self.pop()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.pop()
+        return frames
+
+    def read(self,connection,count):
+        '''
+        Read count raw bytes, buffered ones first. Used for binary transfers.
+        '''
+        data = self.take(count)
+        if len(data) < count:
+            data += connection.read(count - len(data))
+        return data
+
+    def readinto(self,connection,view):
+        '''
+        Fill a memoryview with raw bytes, buffered ones first. Used for binary transfers.
+        '''
+        data = self.take(len(view))
+        if data:
+            view[:len(data)] = data
+            return len(data)
+        return connection.readinto(view)
+
+def frame_reader(connection,termination='\r\n'):
+    '''
+    Get the FrameReader attached to an open port, creating it on first use.
+    Frames are split on the last character of the termination, so replies ending
+    in either '\n' or '\r\n' are handled alike.
+    '''
+    reader = _readers.get(connection)
+    if reader is None:
+        reader = _readers[connection] = FrameReader(termination.encode()[-1:] or b'\n')
+    return reader
+
+class SerialSession:
+
+    def __init__(self,connection_args):
+        '''
+        Long-lived serial port, shared by every RS232 connection on the same
+        comm-port. The port is opened on first use, kept open across calls,
+        and reopened on the next call after a communication error. The port's
+        circuit breaker is kept here too, so that every connection on it sees
+        the same failures.
+
+        args:
+
+            - connection_args: dictionary of keyword arguments for pyserial's Serial class
+        '''
+        self.connection_args = connection_args
+        self.port = connection_args['port']
+        self.lock = threading.RLock()
+        self.users = 0
+        self.connection = None
+        self.breaker = None
+
+    def open(self):
+        '''
+        Return the open port, opening it if this has not been done yet or if
+        it was dropped after an error.
+        '''
+        if self.connection is None or not self.connection.is_open:
+            self.connection = serial.Serial(**self.connection_args)
+        return self.connection
+
+    def reset(self):
+        '''
+        Close the port, ignoring errors from a port that has already gone away.
+        The next call to open() reconnects.
+        '''
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except (serial.SerialException,OSError):
+                pass
+        self.connection = None
+
+    def run(self,function):
+        '''
+        Run function(connection) while holding the port. If the port raises an
+        error, it is closed and the error raised; the next call reopens it.
+        The function is not run again here, since a write may already have
+        reached the device. Queries are repeated by the retry policy instead.
+
+        args:
+
+            - function: callable, taking an open pyserial Serial instance
+
+        return:
+
+            - return value of function
+        '''
+        with self.lock:
+            try:
+                return function(self.open())
+            except errors.InstrumentError:
+                raise
+            except (serial.SerialException,OSError):
+                self.reset()
+                raise
+
+def open_session(connection_args):
+    '''
+    Get the shared session for a comm-port, creating it if necessary. Each call
+    must be paired with release_session(). Raises ValueError if the port is
+    already open with different settings. The timeout may differ, since each
+    connection applies its own on every call.
+
+    args:
+
+        - connection_args: dictionary of keyword arguments for pyserial's Serial class
+
+    return:
+
+        - session: SerialSession
+    '''
+    with _sessions_lock:
+        session = _sessions.get(connection_args['port'])
+        if session is None:
+            session = SerialSession(connection_args)
+            _sessions[session.port] = session
+        elif dict(session.connection_args,timeout=None) != dict(connection_args,timeout=None):
+            raise ValueError('Port {:s} is already open with different settings ({:s}).'.format(session.port,str(session.connection_args)))
+        session.users += 1
+    return session
+
+def release_session(session):
+    '''
+    Drop one user of a shared session. The port is closed once no users remain.
+
+    args:
+
+        - session: SerialSession, as returned by open_session()
+    '''
+    with _sessions_lock:
+        session.users -= 1
+        if session.users > 0:
+            return
+        if _sessions.get(session.port) is session:
+            del _sessions[session.port]
+    with session.lock:
+        session.reset()
+
+def close_all_sessions():
+    '''
+    Close every shared serial port, regardless of how many users remain.
+    '''
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        with session.lock:
+            session.users = 0
+            session.reset()
+
+class RS232(transport.Transport):
+
+    # breaker of a non-persistent connection, which has no session to keep it in
+    own_breaker = None
 
     def __init__(self,comm_args):
         '''
@@ -32,11 +305,15 @@ class RS232:
 
             - comm_args: dictionary of arguments for opening the serial connection.
             Requred keys: "Address", "Baud", "StopBits","ByteSize","Timeout","ErrorScheme"
+            Optional "Persistent" (default True) keeps the port open between calls,
+            shared with any other RS232 connection on the same port. Set it to False
+            to open and close the port around every call.
         '''
         try:
             self.port = comm_args['Address']
         except KeyError:
             raise('Missing "Address" key-value pair for comm-port.')
+        self.bus = self.port
         try:
             self.baud = comm_args['Baud']
         except KeyError:
@@ -79,6 +356,12 @@ class RS232:
 
         self.connection_args = self.connect_config()
 
+        self.persistent = comm_args.get('Persistent',True)
+        if self.persistent:
+            self.session = open_session(self.connection_args)
+        else:
+            self.session = None
+
     def error_identify(self,args):
         '''
         TODO: this needs to be expanded to go beyond parity-check as the
@@ -135,6 +418,60 @@ class RS232:
         message_string = message + self.termination
         return message_string.encode(self.encoding)
 
+    def run(self,function):
+        '''
+        Run function(connection) on an open port: the shared session in persistent
+        mode, otherwise a port opened and closed for this call only. A shared port
+        is given this connection's timeout first.
+
+        args:
+
+            - function: callable, taking an open pyserial Serial instance
+
+        return:
+
+            - return value of function
+        '''
+        if self.session is not None:
+
+            def call(connection):
+                if connection.timeout != self.timeout:
+                    connection.timeout = self.timeout
+                return function(connection)
+
+            return self.session.run(call)
+        with serial.Serial(**self.connection_args) as connection:
+            return function(connection)
+
+    @property
+    def breaker(self):
+        '''
+        Circuit breaker of the port: in persistent mode it belongs to the shared
+        session, so connections on the same port count failures together.
+        '''
+        if self.session is not None:
+            return self.session.breaker
+        return self.own_breaker
+
+    @breaker.setter
+    def breaker(self,breaker):
+        if self.session is not None:
+            self.session.breaker = breaker
+        else:
+            self.own_breaker = breaker
+
+    @property
+    def shared_breaker(self):
+        return self.session is not None and self.session.users > 1
+
+    def close(self):
+        '''
+        Release the shared port. It is closed once no other connection uses it.
+        '''
+        if self.session is not None:
+            release_session(self.session)
+            self.session = None
+
     def write(self,message):
         '''
         Transmit message over the serial bus
@@ -144,15 +481,19 @@ class RS232:
             - message: string, to be transmitted to device
 
         '''
-        with serial.Serial(**self.connection_args) as connection:
-            connection.write(message)
+        start = time.perf_counter()
+        self.run(lambda connection: connection.write(message))
+        metrics = self.metrics
+        if metrics is None:
+            return
+        metrics.observe(self.bus,metrics_module.command_label(message),time.perf_counter() - start)
+        metrics.count('bytes_out',self.bus,len(message))
 
     def query(self,message):
         '''
         Query device status: transmit message, and wait for response.
-        A possible error-check is performed as an intermediate step. The system
-        is given 3 chances to transmit successfully before an empty-string is
-        returned.
+        A possible error-check is performed as an intermediate step. Failed
+        attempts are repeated as the connection's retry policy allows.
 
         args:
 
@@ -161,27 +502,132 @@ class RS232:
         return:
 
             - readstring: string, received from device.
+
+        raises:
+
+            - errors.ErrorCheckFailed or errors.DeviceTimeout once every attempt failed,
+            or errors.DeviceUnavailable while the circuit breaker is open
         '''
 
-        readstring = ''
-        success = False
-        attempts = 0
-        with serial.Serial(**self.connection_args) as connection:
-            while attempts < 3:
-                if not success:
+        counts = {'writes':0,'empty':0,'bytes_in':0}
+
+        def exchange(timeout):
+
+            def transaction(connection):
+                default = connection.timeout
+                if timeout != default:
+                    connection.timeout = timeout
+                try:
+                    if counts['writes']:
+                        # drop a late reply to the previous attempt so it is not taken as this one's
+                        if hasattr(connection,'reset_input_buffer'):
+                            connection.reset_input_buffer()
+                        frame_reader(connection,self.termination).clear()
                     connection.write(message)
-                    success = self.do_error_check(connection)
-                    attempts+=1
-
-                if success:
-                    readstring = str(connection.readline().strip(),self.encoding)
-                    if len(readstring)==0:
-                        attempts+=1
-                        success = False
-                    else:
-                        return readstring
+                    counts['writes'] += 1
+                    if not self.do_error_check(connection):
+                        raise errors.ErrorCheckFailed('Error check failed on {:s}.'.format(self.port),self.bus)
+                    line = frame_reader(connection,self.termination).next_frame(connection)
+                finally:
+                    if timeout != default:
+                        connection.timeout = default
+                counts['bytes_in'] += len(line)
+                readstring = str(line.strip(),self.encoding)
+                if len(readstring)==0:
+                    counts['empty'] += 1
+                    within = '' if timeout is None else ' within {:g} s'.format(timeout)
+                    raise errors.DeviceTimeout('No reply on {:s}{:s}.'.format(self.port,within),self.bus)
+                return readstring
+
+            return self.run(transaction)
+
+        start = time.perf_counter()
+        try:
+            return self.attempt(message,exchange)
+        finally:
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.observe(self.bus,metrics_module.command_label(message),time.perf_counter() - start)
+                metrics.count('bytes_out',self.bus,counts['writes']*len(message))
+                metrics.count('bytes_in',self.bus,counts['bytes_in'])
+                if counts['empty']:
+                    metrics.count('empty_replies',self.bus,counts['empty'])
+
+    def query_binary(self,message,dtype='f4',endianness='>',out=None):
+        '''
+        Query a binary block (IEEE 488.2 '#<n><length>' format), e.g. a waveform or
+        data buffer. The payload is read straight into a buffer and returned as a
+        typed array view of it. Requires numpy.
+
+        args:
+
+            - message: bytes, built query to transmit to device
+
+            - dtype: NumPy dtype of the payload elements
+
+            - endianness: '>' (IEEE 488.2 normal byte order) or '<', or None to use dtype as given
+
+            - out: bytearray or NumPy array to read into, reused between calls to avoid allocation
+
+        return:
+
+            - values: NumPy array view of the payload
+        '''
+        from . import binary_block
 
-        return readstring
+        def transaction(connection):
+            connection.write(message)
+            if not self.do_error_check(connection):
+                raise errors.ErrorCheckFailed('Error check failed for binary query on {:s}.'.format(self.port),self.bus)
+            reader = frame_reader(connection,self.termination)
+            return binary_block.read_block(lambda count: reader.read(connection,count),lambda view: reader.readinto(connection,view),
+                                           dtype,endianness,out,trailer=len(self.termination))
+
+        return self.run(transaction)
+
+    def iter_frames(self,stop_on_timeout=True):
+        '''
+        Generator of frames from a device that streams output continuously. The
+        port is read in chunks and split on the termination, so frames can be
+        consumed at full line rate without per-byte overhead. The port lock is held
+        only while a chunk is read, never while a frame is being consumed.
+
+        args:
+
+            - stop_on_timeout: bool, end the generator when the port times out with no new data.
+            If False, keep waiting until the generator is closed.
+
+        yield:
+
+            - frame: string, one decoded frame without termination
+        '''
+        if self.session is not None:
+            lock = self.session.lock
+            connection = None
+        else:
+            lock = threading.Lock()
+            connection = serial.Serial(**self.connection_args)
+        try:
+            while True:
+                with lock:
+                    if connection is not None:
+                        port = connection
+                    else:
+                        port = self.session.open()
+                        if port.timeout != self.timeout:
+                            port.timeout = self.timeout
+                    frames = frame_reader(port,self.termination).frames(port)
+                if frames is None:
+                    if stop_on_timeout:
+                        return
+                    continue
+                if self.metrics is not None:
+                    self.metrics.count('bytes_in',self.bus,sum(len(frame) for frame in frames))
+                for frame in frames:
+                    yield str(frame.strip(),self.encoding)
+        finally:
+            if connection is not None:
+                connection.close()
 
     def read(self):
         '''
@@ -191,9 +637,10 @@ class RS232:
 
             - linein: raw string read off of the device
         '''
-        with serial.Serial(**self.connection_args) as connection:
-            linein = connection.readline().strip()
-        return str(linein)
+        linein = self.run(lambda connection: frame_reader(connection,self.termination).next_frame(connection))
+        if self.metrics is not None:
+            self.metrics.count('bytes_in',self.bus,len(linein))
+        return str(linein.strip())
 
     def do_error_check(self,connection):
         '''
@@ -216,29 +663,18 @@ class RS232:
             return True
         elif self.error[0] == 'handshake':
 
-            error_read = str(connection.readline().strip(),encoding=self.encoding)
+            if self.metrics is not None:
+                start = time.perf_counter()
+            error_read = str(frame_reader(connection,self.termination).next_frame(connection).strip(),encoding=self.encoding)
             if error_read == self.error[1][0]:
                 error_confirm = self.build(self.error[1][1])
                 connection.write(error_confirm)
+                if self.metrics is not None:
+                    self.metrics.observe(self.bus,'handshake',time.perf_counter() - start)
                 return True
             else:
+                if self.metrics is not None:
+                    self.metrics.observe(self.bus,'handshake failed',time.perf_counter() - start)
                 return False
         else:
             return False
-
-#    def open_comm(self):
-#        '''
-#        Check if communication is open, and if not, open
-#
-#        '''
-#
-#        if not self.connection.is_open:
-#            self.connection.open()
-#
-#    def close_comm(self):
-#        '''
-#        Check if communication is open, and if so, close
-#        '''
-#        if self.connection.is_open:
-#            self.connection.close()
-#
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Simulated communications protocol: an in-process fake instrument.
+
+The Sim connection has the same interface as the hardware protocols (build, write,
+read, query, close), so any Device can run against it with no hardware attached,
+by setting 'Protocol':'Sim' in its communication arguments or Device.simulate = True.
+
+Replies come from a response table and a small SCPI-like memory: writing
+'SOUR1:VOLT 3.2' makes 'SOUR1:VOLT?' reply '3.2'. Compound messages joined with
+';' are handled one part at a time. Wire costs are modelled so that timings are
+meaningful for benchmarks: a fixed round-trip latency, transfer time at the
+configured baud rate, dropped replies that cost a full timeout, and handshake
+bytes for devices using the 'handshake' error scheme.
+
+SCPIServer serves the same simulated instrument over TCP, as a stand-in for a LAN
+instrument when testing the TCP protocol.
+'''
+
+import collections
+import random
+import socket
+import threading
+import time
+from . import errors
+from . import metrics as metrics_module
+from . import transport
+
+class Sim(transport.Transport):
+
+    def __init__(self,communication_args):
+        '''
+        Instantiate the simulated connection.
+
+        args:
+
+            - communication_args: dictionary. All keys are optional:
+                "Address": string, name of the simulated port
+                "Responses": dictionary, message:reply, where reply is a string or a callable(message, sim)
+                    returning a string; or a single callable(message, sim) returning a string, or None to fall through
+                "Default": string, reply to unknown queries (default '0'). None models a device that does not answer.
+                "Latency": float, seconds of round-trip latency per exchange (default 0)
+                "Baud": int, line rate used to charge transfer time, 10 bits per byte. No limit if absent.
+                "DropRate": float, probability that a reply is lost (default 0)
+                "Timeout": float, seconds spent waiting for a lost reply (default 2.0)
+                "ErrorScheme": ('handshake',(acknowledge,confirm)) adds a handshake exchange to every message
+                "Terminator"/"Termination": string, message termination (default '\\n')
+                "Seed": int, seed for the random number generator used for dropped replies
+        '''
+        self.address = communication_args.get('Address','Sim')
+        self.bus = 'Sim:' + str(self.address)
+        self.responses = communication_args.get('Responses',{})
+        self.default = communication_args.get('Default','0')
+        self.latency = communication_args.get('Latency',0.0)
+        self.baud = communication_args.get('Baud')
+        self.drop_rate = communication_args.get('DropRate',0.0)
+        self.timeout = communication_args.get('Timeout',2.0)
+        self.termination = communication_args.get('Terminator',communication_args.get('Termination','\n'))
+        self.encoding = communication_args.get('Encoding','utf-8')
+        self.random = random.Random(communication_args.get('Seed'))
+
+        scheme = communication_args.get('ErrorScheme')
+        if isinstance(scheme,(tuple,list)) and len(scheme) > 1 and str(scheme[0]).lower() == 'handshake':
+            self.handshake = tuple(scheme[1])
+        else:
+            self.handshake = None
+
+        self.state = {}
+        self.pending = []
+        self.log = collections.deque(maxlen=1000)
+        self.is_open = True
+
+    def close(self):
+        '''
+        Close the simulated connection.
+        '''
+        self.is_open = False
+
+    def build(self,message):
+        '''
+        Build a message string with correct termination. Messages that are already
+        terminated are left as they are.
+        '''
+        if isinstance(message,bytes):
+            message = str(message,self.encoding)
+        if message.endswith(self.termination):
+            return message
+        return message + self.termination
+
+    def transfer(self,nbytes):
+        '''
+        Charge the time it takes to move nbytes over the simulated line.
+        '''
+        if self.baud:
+            time.sleep(10.0*nbytes/self.baud)
+
+    def exchange_handshake(self):
+        '''
+        Simulate the acknowledge/confirm exchange that follows every message on
+        devices using the handshake error scheme.
+        '''
+        if self.handshake is None:
+            return
+        self.transfer(len(self.handshake[0]) + len(self.handshake[1]) + 2*len(self.termination))
+        time.sleep(self.latency)
+
+    def respond(self,part):
+        '''
+        Work out the device's reply to a single (non-compound) message.
+
+        args:
+
+            - part: string, message without termination
+
+        return:
+
+            - reply: string, or None if the device says nothing
+        '''
+        key = part.lstrip(':')
+        if callable(self.responses):
+            reply = self.responses(part,self)
+            if reply is not None:
+                return reply
+        elif part in self.responses or key in self.responses:
+            reply = self.responses.get(part,self.responses.get(key))
+            return reply(part,self) if callable(reply) else reply
+
+        header,_,argument = key.partition(' ')
+        if header.endswith('?'):
+            return self.state.get(header[:-1],self.default)
+        if argument:
+            self.state[header] = argument
+        return None
+
+    def write(self,message):
+        '''
+        Send a message to the simulated device. Replies to any queries in it are
+        queued for the next read().
+
+        args:
+
+            - message: string or bytes
+        '''
+        if not self.is_open:
+            raise ConnectionError('Simulated connection {:s} is closed.'.format(str(self.address)))
+        message = self.build(message)
+        self.transfer(len(message))
+        self.exchange_handshake()
+        self.log.append(message)
+
+        replies = [self.respond(part.strip()) for part in message[:-len(self.termination) or None].split(';')]
+        replies = [reply for reply in replies if reply is not None]
+        if replies:
+            self.pending.append(';'.join(replies))
+
+    def receive(self,timeout=None):
+        '''
+        Take the next reply off the simulated wire. A lost reply, or no reply at
+        all, costs the full timeout and gives an empty string.
+
+        args:
+
+            - timeout: float, seconds to wait, the connection's Timeout if None
+
+        return:
+
+            - message: string, reply from the simulated device
+        '''
+        time.sleep(self.latency)
+        if not self.pending or self.random.random() < self.drop_rate:
+            self.pending.clear()
+            timeout = self.timeout if timeout is None else timeout
+            if timeout is not None:
+                time.sleep(timeout)
+            return ''
+        reply = self.pending.pop(0)
+        self.transfer(len(reply) + len(self.termination))
+        return reply.strip()
+
+    def reply(self,message,timeout):
+        '''
+        One attempt at reading a reply, raising errors.DeviceTimeout if there is none.
+        '''
+        reply = self.receive(timeout)
+        if not reply:
+            within = '' if timeout is None else ' within {:g} s'.format(timeout)
+            raise errors.DeviceTimeout('No reply from {:s}{:s}.'.format(str(self.address),within),self.bus,metrics_module.command_label(message))
+        return reply
+
+    def read(self):
+        '''
+        Read the next reply, once. No reply raises errors.DeviceTimeout, as the
+        hardware protocols do, or gives an empty string if the retry policy has
+        raise_errors=False.
+
+        return:
+
+            - message: string, reply from the simulated device
+        '''
+        return self.attempt('read',lambda timeout: self.reply('read',timeout),retry=False)
+
+    def query(self,message):
+        '''
+        Combined write-read command, repeated as the retry policy allows.
+
+        args:
+
+            - message: string, question to transmit to the simulated device
+
+        return:
+
+            - message: string, reply from the simulated device
+        '''
+        writes = []
+
+        def exchange(timeout):
+            self.write(message)
+            writes.append(message)
+            return self.reply(message,timeout)
+
+        start = time.perf_counter()
+        reply = ''
+        try:
+            reply = self.attempt(message,exchange)
+            return reply
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(self.bus,metrics_module.command_label(message),time.perf_counter() - start)
+                self.metrics.count('bytes_out',self.bus,len(writes)*len(self.build(message)))
+                self.metrics.count('bytes_in',self.bus,len(reply))
+                if not reply:
+                    self.metrics.count('empty_replies',self.bus)
+
+class SCPIServer:
+
+    def __init__(self,communication_args=None,host='127.0.0.1',port=0):
+        '''
+        Serve a simulated instrument over TCP. Incoming bytes are split on the
+        termination and each message is answered in order, so pipelined queries
+        work as on a real instrument. Messages without a reply (writes, dropped
+        replies) send nothing back. All clients talk to the same instrument, so its
+        settings survive a reconnect.
+
+        args:
+
+            - communication_args: dictionary, as for Sim. Latency is charged once per
+            packet received rather than per message, as a network round trip would be.
+
+            - host: string, interface to listen on
+
+            - port: int, port to listen on. 0 picks a free port; see address.
+        '''
+        communication_args = dict(communication_args or {})
+        self.latency = communication_args.pop('Latency',0.0)
+        self.sim = Sim(communication_args)
+        self.lock = threading.Lock()
+        self.listener = socket.create_server((host,port))
+        self.host,self.port = self.listener.getsockname()[:2]
+        self.address = '{:s}:{:d}'.format(self.host,self.port)
+        self.clients = []
+        self.thread = threading.Thread(target=self.serve,name='SCPIServer {:s}'.format(self.address),daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                client,_ = self.listener.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+            threading.Thread(target=self.handle,args=(client,),daemon=True).start()
+
+    def handle(self,client):
+        sim = self.sim
+        separator = sim.termination.encode(sim.encoding)[-1:] or b'\n'
+        buffer = b''
+        try:
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    return
+                buffer += chunk
+                *messages,buffer = buffer.split(separator)
+                time.sleep(self.latency)
+                with self.lock:
+                    replies = []
+                    for message in messages:
+                        sim.write(message + separator)
+                        if sim.pending:
+                            reply = sim.receive()
+                            if reply:
+                                replies.append(sim.build(reply))
+                if replies:
+                    client.sendall(''.join(replies).encode(sim.encoding))
+        except OSError:
+            return
+        finally:
+            client.close()
+
+    def close(self):
+        '''
+        Stop listening and drop all clients.
+        '''
+        self.listener.close()
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
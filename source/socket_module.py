@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Raw SCPI over TCP ('Protocol':'TCP'), as spoken by most LAN instruments on port 5025.
+
+Messages go straight onto a socket, with Nagle's algorithm off so short commands
+leave at once, and TCP keep-alive on so a dead link is noticed. Replies are read
+in chunks and split on the termination. query_many pipelines a batch: all
+queries are sent back to back and the replies read in order, so K queries cost
+one round trip rather than K.
+
+If the link drops, the socket is reopened and the exchange tried once more. After
+a timeout the connection is reopened before the next exchange, so that a late
+reply cannot be taken as the answer to a later query. Queries that still fail are
+repeated as the connection's retry policy allows, then raise errors.InstrumentError.
+
+For testing without hardware, sim_module.SCPIServer serves the Sim protocol on a
+local port.
+'''
+
+import socket
+import time
+from . import errors
+from . import metrics as metrics_module
+from . import transport
+
+def parse_address(address,port=5025):
+    '''
+    Split an address into host and port. Accepts 'host', 'host:port' and VISA
+    socket resource names such as 'TCPIP0::192.168.1.5::5025::SOCKET'.
+
+    return:
+
+        - (host, port)
+    '''
+    if '::' in address:
+        parts = address.split('::')
+        if len(parts) > 3 and parts[2].isdigit():
+            port = int(parts[2])
+        return parts[1],port
+    host,_,number = address.rpartition(':')
+    if host and number.isdigit():
+        return host,int(number)
+    return address,port
+
+class TCP(transport.Transport):
+
+    def __init__(self,communication_args):
+        '''
+        Open a socket connection.
+
+        args:
+
+            - communication_args: dictionary. "Address" is required, as 'host', 'host:port'
+            or a VISA 'TCPIP::host::port::SOCKET' name. Optional keys:
+                "Port": int, used if the address has none (default 5025)
+                "Timeout": float, seconds allowed for a single exchange (default 2.0)
+                "Terminator"/"Termination": string, message termination (default '\\n')
+                "Encoding": string (default 'utf-8')
+                "NoDelay": bool, disable Nagle's algorithm (default True)
+                "KeepAlive": bool, enable TCP keep-alive probes (default True)
+                "Reconnect": int, times to reopen the socket and retry an exchange after the link drops (default 1)
+        '''
+        self.address = communication_args['Address']
+        self.host,self.port = parse_address(self.address,communication_args.get('Port',5025))
+        self.bus = 'TCP:{:s}:{:d}'.format(self.host,self.port)
+        self.timeout = communication_args.get('Timeout',2.0)
+        self.termination = communication_args.get('Terminator',communication_args.get('Termination','\n'))
+        self.separator = self.termination.encode()[-1:] or b'\n'
+        self.encoding = communication_args.get('Encoding','utf-8')
+        self.nodelay = communication_args.get('NoDelay',True)
+        self.keepalive = communication_args.get('KeepAlive',True)
+        self.reconnect = communication_args.get('Reconnect',1)
+        self.buffer = bytearray()
+        self.chunk = bytearray(65536)
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        '''
+        Open the socket, replacing any previous one.
+        '''
+        self.disconnect()
+        connection = socket.create_connection((self.host,self.port),timeout=self.timeout)
+        if self.nodelay:
+            connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        if self.keepalive:
+            connection.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        self.socket = connection
+        self.buffer.clear()
+
+    def disconnect(self):
+
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            self.socket = None
+
+    def close(self):
+
+        self.disconnect()
+
+    def build(self,message):
+        '''
+        Build a message with correct termination, as bytes. Messages that are already
+        terminated are left as they are.
+        '''
+        if isinstance(message,str):
+            message = message.encode(self.encoding)
+        if message.endswith(self.termination.encode()):
+            return message
+        return message + self.termination.encode()
+
+    def run(self,function,timeout=None):
+        '''
+        Run function() on an open socket, reopening it and trying again if the link drops.
+        A timeout inside function raises errors.DeviceTimeout, and leaves the socket to be
+        reopened before the next call.
+
+        args:
+
+            - function: callable, exchanging with self.socket
+
+            - timeout: float, seconds allowed per socket operation, the connection's Timeout if None
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        for attempt in range(self.reconnect + 1):
+            try:
+                if self.socket is None:
+                    self.connect()
+                if self.socket.gettimeout() != timeout:
+                    self.socket.settimeout(timeout)
+                return function()
+            except socket.timeout:
+                self.disconnect()
+                raise errors.DeviceTimeout('No reply from {:s} within {:g} s.'.format(self.bus,timeout),self.bus)
+            except OSError:
+                self.disconnect()
+                if attempt == self.reconnect:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.count('reconnects',self.bus)
+
+    def receive(self):
+        '''
+        Append whatever the socket has to the buffer, through a reused chunk buffer.
+
+        return:
+
+            - count: int, bytes received; 0 if the device closed the connection
+        '''
+        count = self.socket.recv_into(self.chunk)
+        self.buffer += memoryview(self.chunk)[:count]
+        return count
+
+    def next_frame(self):
+        '''
+        Read one terminated reply off the socket, without the termination.
+        '''
+        while True:
+            end = self.buffer.find(self.separator)
+            if end >= 0:
+                frame = bytes(self.buffer[:end+1])
+                del self.buffer[:end+1]
+                return frame
+            if not self.receive():
+                raise ConnectionError('{:s} closed the connection.'.format(self.bus))
+
+    def read_bytes(self,count):
+        '''
+        Read count bytes, taking any buffered bytes first. Fewer are returned only if
+        the device closes the connection.
+        '''
+        while len(self.buffer) < count:
+            if not self.receive():
+                break
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+    def decode(self,frame):
+
+        return str(frame,self.encoding).strip()
+
+    def reply(self,frame,message):
+        '''
+        Decode a reply, raising errors.DeviceTimeout if it is empty, as the other transports do.
+        '''
+        reply = self.decode(frame)
+        if not reply:
+            raise errors.DeviceTimeout('Empty reply from {:s}.'.format(self.bus),self.bus,metrics_module.command_label(message))
+        return reply
+
+    def write(self,message):
+        '''
+        Transmit a message.
+
+        args:
+
+            - message: string or bytes
+        '''
+        message = self.build(message)
+        start = time.perf_counter()
+        self.run(lambda: self.socket.sendall(message))
+        if self.metrics is not None:
+            self.record(message,start,None)
+
+    def read(self):
+        '''
+        Read the next reply, once. Raises errors.DeviceTimeout if the device does not answer
+        in time or answers with an empty line, or returns an empty string if the retry policy has raise_errors=False.
+        '''
+        reply = self.attempt('read',lambda timeout: self.reply(self.run(self.next_frame,timeout),'read'),retry=False)
+        if not reply and self.metrics is not None:
+            self.metrics.count('empty_replies',self.bus)
+        return reply
+
+    def query(self,message):
+        '''
+        Combined write-read command, repeated as the retry policy allows. An empty
+        reply counts as no reply. Raises errors.InstrumentError if the device never
+        answers in time.
+
+        args:
+
+            - message: string or bytes, query to transmit
+
+        return:
+
+            - reply: string
+        '''
+        message = self.build(message)
+
+        def exchange():
+            self.socket.sendall(message)
+            return self.next_frame()
+
+        start = time.perf_counter()
+        reply = ''
+        try:
+            reply = self.attempt(message,lambda timeout: self.reply(self.run(exchange,timeout),message))
+            return reply
+        finally:
+            if self.metrics is not None:
+                self.record(message,start,reply)
+
+    def query_many(self,messages):
+        '''
+        Pipeline a batch of queries: send them all, then read the replies in order.
+        The whole batch is repeated as the retry policy allows, with the longest timeout
+        of its commands. If it still fails, errors.InstrumentError is raised, or every
+        reply is an empty string if the policy has raise_errors=False.
+
+        args:
+
+            - messages: list of strings or bytes, one query each
+
+        return:
+
+            - replies: list of strings
+        '''
+        messages = [self.build(message) for message in messages]
+        payload = b''.join(messages)
+        replies = []
+
+        def exchange():
+            replies.clear()
+            self.socket.sendall(payload)
+            return [self.next_frame() for _ in messages]
+
+        def attempt(timeout):
+            frames = self.run(exchange,timeout)
+            replies.extend(self.reply(frame,message) for frame,message in zip(frames,messages))
+
+        # label for the policy: the headers of the batch as one compound message
+        label = b';'.join(message.strip() for message in messages)
+        start = time.perf_counter()
+        try:
+            if self.attempt(label,attempt) == '':
+                replies[:] = [''] * len(messages)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(self.bus,'query_many',time.perf_counter() - start)
+                self.metrics.count('bytes_out',self.bus,len(payload))
+                self.metrics.count('bytes_in',self.bus,sum(len(reply) for reply in replies))
+        return replies
+
+    def query_binary(self,query,dtype='f4',endianness='>',out=None):
+        '''
+        Query a binary block (IEEE 488.2 '#<n><length>' format) and return it as a
+        typed NumPy array view, read straight into the buffer. Requires numpy.
+
+        args:
+
+            - query: string or bytes, query to transmit
+
+            - dtype: NumPy dtype of the payload elements
+
+            - endianness: '>' (IEEE 488.2 normal byte order) or '<', or None to use dtype as given
+
+            - out: bytearray or NumPy array to read into, reused between calls to avoid allocation
+
+        return:
+
+            - values: NumPy array view of the payload
+        '''
+        from . import binary_block
+        message = self.build(query)
+
+        def readinto(view):
+            if self.buffer:
+                count = min(len(view),len(self.buffer))
+                view[:count] = self.buffer[:count]
+                del self.buffer[:count]
+                return count
+            return self.socket.recv_into(view)
+
+        def exchange():
+            self.socket.sendall(message)
+            return binary_block.read_block(self.read_bytes,readinto,dtype,endianness,out,trailer=len(self.termination))
+
+        return self.run(exchange)
+
+    def record(self,message,start,reply):
+        '''Record one exchange in the metrics: duration, bytes each way and empty replies.'''
+        self.metrics.observe(self.bus,metrics_module.command_label(message),time.perf_counter() - start)
+        self.metrics.count('bytes_out',self.bus,len(message))
+        if reply is None:
+            return
+        self.metrics.count('bytes_in',self.bus,len(reply))
+        if not reply:
+            self.metrics.count('empty_replies',self.bus)
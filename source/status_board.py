@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Latest device status in shared memory, readable by any local process.
+
+A StatusBoard is a multiprocessing.shared_memory segment holding one fixed-layout
+record per device: a sequence counter, an int64 epoch-nanosecond timestamp and
+one float64 per status command. The process that polls (see
+StatusPoller.enable_status_board) publishes into it after every get_status.
+Other processes attach by name and read the latest values straight from the
+segment, with no bus transaction, socket or unpickling. Readers never block the
+writer or each other, so dozens of them cost the writer nothing.
+
+Each record is guarded by a sequence lock. The writer makes the counter odd,
+writes the record, then makes it even again. A reader copies the record and keeps
+the copy only if the counter was even and unchanged across the copy. Otherwise it
+yields and tries again, for up to a timeout. A record left half-written by a
+writer that died then raises TimeoutError instead of spinning forever.
+
+Segment layout (native byte order, every block 8-byte aligned):
+
+    header:  b'ISTB0001', uint32 layout length, uint32 padding,
+             JSON {"devices": [{"name": ..., "columns": [...]}, ...]} padded to 8 bytes
+    records: for each device in turn, uint64 sequence, int64 timestamp, float64[columns]
+
+Readings are stored as floats (status_logger.to_float): booleans become 1.0/0.0
+and anything that is not a number becomes NaN. Requires numpy.
+'''
+
+import json
+import struct
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .status_logger import to_float
+
+MAGIC = b'ISTB0001'
+prefix = struct.Struct('=8sII')
+
+def pad(size):
+
+    return (size + 7) // 8 * 8
+
+class StatusBoard:
+
+    def __init__(self,name=None,layout=None):
+        '''
+        Create a status board, or attach to an existing one.
+
+        args:
+
+            - name: string, name of the shared memory segment. A fresh name is chosen when creating with None.
+
+            - layout: list of (device name, list of status columns) to create a board, or None to attach to board name.
+            Device names must be unique.
+        '''
+        if layout is None:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            # attaching registers the segment with this process's resource tracker, which
+            # would unlink it when this process exits (bpo-39959); only the creator should
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.memory._name,'shared_memory')
+            except Exception:
+                pass
+            magic,size,_ = prefix.unpack_from(self.memory.buf,0)
+            if magic != MAGIC:
+                self.memory.close()
+                raise ValueError('{:s} is not a status board.'.format(str(name)))
+            self.layout = json.loads(bytes(self.memory.buf[prefix.size:prefix.size+size]).decode('utf-8'))['devices']
+        else:
+            self.layout = [{'name':str(device),'columns':list(columns)} for device,columns in layout]
+            names = [device['name'] for device in self.layout]
+            if len(set(names)) != len(names):
+                raise ValueError('Device names on a status board must be unique: {:s}.'.format(', '.join(names)))
+            text = json.dumps({'devices':self.layout}).encode('utf-8')
+            start = pad(prefix.size + len(text))
+            total = start + sum(8*(2 + len(device['columns'])) for device in self.layout)
+            self.memory = shared_memory.SharedMemory(name=name,create=True,size=max(total,1))
+            self.owner = True
+            self.memory.buf[:prefix.size + len(text)] = prefix.pack(MAGIC,len(text),0) + text
+        self.name = self.memory.name
+
+        size, = struct.unpack_from('=I',self.memory.buf,8)
+        offset = pad(prefix.size + size)
+        self.records = []
+        self.index = {}
+        for number,device in enumerate(self.layout):
+            count = len(device['columns'])
+            sequence = np.ndarray(1,dtype=np.uint64,buffer=self.memory.buf,offset=offset)
+            timestamp = np.ndarray(1,dtype=np.int64,buffer=self.memory.buf,offset=offset + 8)
+            values = np.ndarray(count,dtype=np.float64,buffer=self.memory.buf,offset=offset + 16)
+            self.records.append((sequence,timestamp,values))
+            self.index[device['name']] = number
+            offset += 8*(2 + count)
+
+    @classmethod
+    def for_devices(cls,devices,name=None):
+        '''
+        Create a board laid out for a list of devices, one record per device with a
+        column per status command, in the order given. Devices sharing a name are
+        told apart as 'name', 'name#2', 'name#3', ...; record numbers are always unique.
+        '''
+        layout = []
+        seen = {}
+        for device in devices:
+            count = seen[str(device.name)] = seen.get(str(device.name),0) + 1
+            label = str(device.name) if count == 1 else '{:s}#{:d}'.format(str(device.name),count)
+            layout.append((label,list(device.StatusCommands)))
+        return cls(name,layout)
+
+    def lookup(self,device):
+        '''
+        Record number for a device name or number.
+        '''
+        if isinstance(device,int):
+            return device
+        try:
+            return self.index[device]
+        except KeyError:
+            raise KeyError('No device named {:s} on status board {:s}.'.format(str(device),self.name))
+
+    def publish(self,device,status,timestamp):
+        '''
+        Write the latest readings of one device. Only one process may publish to a board.
+
+        args:
+
+            - device: string or int, device name or record number
+
+            - status: dictionary, status command:reading, as Device.Status
+
+            - timestamp: int, epoch nanoseconds
+        '''
+        number = self.lookup(device)
+        sequence,stamp,values = self.records[number]
+        readings = [to_float(status.get(column)) for column in self.layout[number]['columns']]
+        sequence[0] += 1
+        stamp[0] = timestamp
+        values[:] = readings
+        sequence[0] += 1
+
+    def read(self,device,timeout=0.1):
+        '''
+        Latest readings of one device, consistent with a single publish.
+
+        args:
+
+            - device: string or int, device name or record number
+
+            - timeout: float, seconds to keep retrying while the record is being written.
+            TimeoutError is raised after that, e.g. if the writer died during a publish.
+
+        return:
+
+            - timestamp: int, epoch nanoseconds, 0 if nothing has been published yet
+
+            - values: dictionary, status command:float
+        '''
+        number = self.lookup(device)
+        sequence,stamp,values = self.records[number]
+        deadline = None
+        while True:
+            before = int(sequence[0])
+            if not before % 2:
+                timestamp = int(stamp[0])
+                copy = values.copy()
+                if int(sequence[0]) == before:
+                    return timestamp,dict(zip(self.layout[number]['columns'],copy.tolist()))
+            # the writer is mid-publish: let it run, and give up if it never finishes
+            if deadline is None:
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError('Record {:s} on status board {:s} stayed mid-update for {:g} s.'.format(self.layout[number]['name'],self.name,timeout))
+            time.sleep(0)
+
+    def read_all(self):
+        '''
+        Latest readings of every device.
+
+        return:
+
+            - dictionary, device name:(timestamp, values) as returned by read
+        '''
+        return {device['name']:self.read(number) for number,device in enumerate(self.layout)}
+
+    def close(self):
+        '''
+        Detach from the board. The creator also removes the segment.
+        '''
+        self.records = []
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
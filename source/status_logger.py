@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Streaming status recorder with a compact columnar binary format.
+
+Each get_status cycle becomes one row: an int64 epoch-nanosecond timestamp and
+one float64 per status command. Rows are buffered in preallocated arrays and
+written in bulk as chunks. Within a chunk, each column is stored contiguously.
+Files rotate once they reach a size limit, as <name>_0000.ilog, <name>_0001.ilog, ...
+
+File layout (little-endian, every block 8-byte aligned):
+
+    header: b'ILOG0001', uint32 header length, uint32 padding, JSON {"columns": [...], ...} padded to 8 bytes
+    chunk:  b'CHNK', uint32 column count, uint64 row count,
+            int64[rows] timestamps, then float64[rows] for each column in turn
+
+LogReader memory-maps the files and hands out NumPy views straight onto the
+chunks, so even multi-GB logs open instantly and no text is parsed. Whole-run
+columns are ColumnViews over those chunks: only the rows sliced out are read.
+'''
+
+import glob
+import json
+import math
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from . import command_template
+
+MAGIC = b'ILOG0001'
+CHUNK_MAGIC = b'CHNK'
+EXTENSION = '.ilog'
+
+def to_float(value):
+    '''
+    Convert a status reading to float64. Booleans become 1.0/0.0, including
+    replies such as 'ON'/'OFF' that command_template reads as booleans; anything
+    that cannot be read as a number becomes NaN.
+    '''
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        pass
+    try:
+        return float(command_template.parse_bool(value))
+    except (AttributeError,ValueError):
+        return math.nan
+
+def run_files(path):
+    '''
+    List the files of a recorded run in order.
+
+    args:
+
+        - path: string, the path given to StatusRecorder, or a single .ilog file
+
+    return:
+
+        - files: list of strings
+    '''
+    if os.path.isfile(path):
+        return [path]
+    stem = path[:-len(EXTENSION)] if path.endswith(EXTENSION) else path
+    return sorted(glob.glob(glob.escape(stem) + '_[0-9][0-9][0-9][0-9]' + EXTENSION))
+
+class StatusRecorder:
+
+    def __init__(self,path,columns,chunk_rows=1024,max_file_bytes=256*2**20,flush_interval=None,metadata=None):
+        '''
+        Open a recorder. Nothing is written until the first chunk is flushed.
+
+        args:
+
+            - path: string, base name of the log files. Raises FileExistsError if a run was already recorded there.
+
+            - columns: list of strings, status keys to record, in order
+
+            - chunk_rows: int, rows buffered in memory before they are written as one chunk
+
+            - max_file_bytes: int, size after which a new file is started
+
+            - flush_interval: float, seconds. If set, buffered rows are also written once they are this old.
+
+            - metadata: dictionary, extra JSON-serializable information stored in each file header
+        '''
+        self.stem = path[:-len(EXTENSION)] if path.endswith(EXTENSION) else path
+        self.columns = list(columns)
+        self.chunk_rows = chunk_rows
+        self.max_file_bytes = max_file_bytes
+        self.flush_interval = flush_interval
+        self.metadata = metadata or {}
+        self.lock = threading.Lock()
+
+        self.times = np.empty(chunk_rows,dtype='<i8')
+        self.values = np.empty((len(self.columns),chunk_rows),dtype='<f8')
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+        self.header_bytes = self.header()
+        if run_files(self.stem):
+            raise FileExistsError('A status log already exists at {:s}; choose another path so that runs are not mixed.'.format(self.stem))
+        self.index = 0
+        self.file = None
+        self.file_bytes = 0
+
+    def header(self):
+        body = json.dumps(dict(self.metadata,columns=self.columns)).encode()
+        body += b' '*(-len(body) % 8)
+        return MAGIC + struct.pack('<II',len(body),0) + body
+
+    def open_next(self):
+        if self.file is not None:
+            self.file.close()
+        name = '{:s}_{:04d}{:s}'.format(self.stem,self.index,EXTENSION)
+        self.index += 1
+        self.file = open(name,'wb')
+        self.file_bytes = self.file.write(self.header_bytes)
+
+    def record(self,status,timestamp=None):
+        '''
+        Append one status reading.
+
+        args:
+
+            - status: dictionary, as Device.Status
+
+            - timestamp: int, epoch nanoseconds. Defaults to now.
+        '''
+        if timestamp is None:
+            timestamp = time.time_ns()
+        with self.lock:
+            row = self.rows
+            self.times[row] = timestamp
+            for index,column in enumerate(self.columns):
+                self.values[index,row] = to_float(status.get(column))
+            self.rows += 1
+            if self.rows == self.chunk_rows or (self.flush_interval is not None and time.monotonic() - self.last_flush > self.flush_interval):
+                self.write_chunk()
+
+    def write_chunk(self):
+        if self.rows == 0:
+            return
+        rows = self.rows
+        size = 16 + 8*rows*(1 + len(self.columns))
+        if self.file is None or (self.file_bytes + size > self.max_file_bytes and self.file_bytes > len(self.header_bytes)):
+            self.open_next()
+        parts = [CHUNK_MAGIC + struct.pack('<IQ',len(self.columns),rows),self.times[:rows].tobytes()]
+        parts += [self.values[index,:rows].tobytes() for index in range(len(self.columns))]
+        self.file.write(b''.join(parts))
+        self.file.flush()
+        self.file_bytes += size
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        '''
+        Write any buffered rows to disk.
+        '''
+        with self.lock:
+            self.write_chunk()
+
+    def close(self):
+        '''
+        Flush and close the current file.
+        '''
+        with self.lock:
+            self.write_chunk()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+class ColumnView:
+
+    def __init__(self,parts,dtype):
+        '''
+        One column of a whole run, as a sequence over the per-chunk views without
+        copying them. Indexing and slicing read only the rows asked for. A slice
+        within one chunk is a view onto the file. np.asarray(view) copies the
+        whole column into memory.
+
+        args:
+
+            - parts: list of NumPy arrays, the column in each chunk, in order
+
+            - dtype: NumPy dtype of the column
+        '''
+        self.parts = parts
+        self.dtype = np.dtype(dtype)
+        self.starts = np.cumsum([0] + [len(part) for part in parts])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def chunks(self):
+        '''
+        Per-chunk views onto the files, for processing a run one chunk at a time.
+        '''
+        return list(self.parts)
+
+    def gather(self,positions):
+
+        result = np.empty(len(positions),dtype=self.dtype)
+        owners = np.searchsorted(self.starts,positions,side='right') - 1
+        for number,part in enumerate(self.parts):
+            mask = owners == number
+            if mask.any():
+                result[mask] = part[positions[mask] - self.starts[number]]
+        return result
+
+    def __getitem__(self,key):
+        if isinstance(key,slice):
+            start,stop,step = key.indices(len(self))
+            if step != 1:
+                return self.gather(np.arange(start,stop,step))
+            pieces = []
+            for part,offset in zip(self.parts,self.starts[:-1]):
+                low,high = max(start - offset,0),min(stop - offset,len(part))
+                if low < high:
+                    pieces.append(part[low:high])
+            if len(pieces) == 1:
+                return pieces[0]
+            if not pieces:
+                return np.empty(0,dtype=self.dtype)
+            return np.concatenate(pieces)
+        if isinstance(key,(int,np.integer)):
+            index = int(key) + len(self) if key < 0 else int(key)
+            if not 0 <= index < len(self):
+                raise IndexError('Row {:d} is out of range for a column of {:d} rows.'.format(int(key),len(self)))
+            number = int(np.searchsorted(self.starts,index,side='right')) - 1
+            return self.parts[number][index - self.starts[number]]
+        positions = np.arange(len(self))[key]
+        return self.gather(positions)
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+    def __array__(self,dtype=None,copy=None):
+        array = self[:]
+        if len(self.parts) == 1:
+            array = np.array(array)
+        return array if dtype is None else array.astype(dtype)
+
+class LogReader:
+
+    def __init__(self,path):
+        '''
+        Open a recorded run (or a single file) for reading. Only chunk headers
+        are read here; the data stays on disk until it is touched.
+
+        args:
+
+            - path: string, the path given to StatusRecorder, or a single .ilog file
+        '''
+        self.files = run_files(path)
+        if not self.files:
+            raise FileNotFoundError('No status log found at {:s}.'.format(path))
+        self.maps = []
+        self.chunks = []
+        self.columns = None
+        self.metadata = None
+        for name in self.files:
+            self.scan(name)
+
+    def scan(self,name):
+        data = np.memmap(name,dtype=np.uint8,mode='r')
+        self.maps.append(data)
+        if bytes(data[:8]) != MAGIC:
+            raise ValueError('{:s} is not a status log.'.format(name))
+        length = struct.unpack('<I',bytes(data[8:12]))[0]
+        metadata = json.loads(bytes(data[16:16+length]))
+        if self.columns is None:
+            self.columns = metadata['columns']
+            self.metadata = metadata
+        elif metadata['columns'] != self.columns:
+            raise ValueError('{:s} records different columns from the rest of the run.'.format(name))
+
+        offset = 16 + length
+        while offset + 16 <= len(data):
+            if bytes(data[offset:offset+4]) != CHUNK_MAGIC:
+                break
+            ncolumns,rows = struct.unpack('<IQ',bytes(data[offset+4:offset+16]))
+            end = offset + 16 + 8*rows*(1 + ncolumns)
+            if end > len(data):
+                # chunk cut short, e.g. by a crash while writing
+                break
+            self.chunks.append((data,offset+16,rows))
+            offset = end
+
+    def iter_chunks(self):
+        '''
+        Iterate over the chunks of the run without copying.
+
+        return:
+
+            - generator of dictionaries, 'Time' and each column name:read-only NumPy view onto the file
+        '''
+        ncolumns = len(self.columns)
+        for data,offset,rows in self.chunks:
+            block = np.frombuffer(data,dtype='<i8',count=rows*(1 + ncolumns),offset=offset)
+            chunk = {'Time':block[:rows]}
+            floats = block[rows:].view('<f8').reshape(ncolumns,rows)
+            for index,column in enumerate(self.columns):
+                chunk[column] = floats[index]
+            yield chunk
+
+    def __len__(self):
+        return sum(rows for _,_,rows in self.chunks)
+
+    def column(self,name):
+        '''
+        Whole-run column ('Time' for the timestamps), as a ColumnView over the
+        chunks. Nothing is read or copied until it is indexed.
+        '''
+        return ColumnView([chunk[name] for chunk in self.iter_chunks()],'<i8' if name == 'Time' else '<f8')
+
+    def read(self):
+        '''
+        The whole run, as lazy columns.
+
+        return:
+
+            - data: dictionary, 'Time' and each column name:ColumnView
+        '''
+        return {name:self.column(name) for name in ['Time'] + self.columns}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Transport interface and protocol registry.
+
+A transport is the connection class behind a Device: it turns messages into bytes
+on some wire and replies back into strings. Every transport offers build, write,
+read, query and close. Transport supplies query_many for batches and awaitable
+variants of each call, which transports can override with something faster.
+For example, a socket transport can pipeline a batch of queries in one round trip.
+Transports run each exchange through attempt(), which applies the connection's
+retry policy and circuit breaker (see retry) and raises errors from errors.
+
+Devices pick their transport by the 'Protocol' communication argument. Protocol
+names resolve through the registry below, which maps a name to a transport class,
+or to a 'module:Class' string imported on first use. The built-in transports are
+registered this way, so pyvisa or pyserial load only when a device uses them.
+Other packages can add transports without touching this library:
+
+    - at run time, with register('TCP', MyTransport) or register('TCP', 'mypackage.tcp:MyTransport')
+
+    - when installed, through an entry point in the 'instrumentlibrary.transports' group,
+      e.g. in pyproject.toml:
+
+        [project.entry-points."instrumentlibrary.transports"]
+        TCP = "mypackage.tcp:MyTransport"
+
+Entry points are only looked up for protocol names not already registered.
+'''
+
+import functools
+import importlib
+import threading
+
+from . import retry
+
+entry_point_group = 'instrumentlibrary.transports'
+
+class Transport:
+
+    # physical bus identifier used for locking and polling; None if the connection has a bus of its own
+    bus = None
+    # seconds allowed for a single exchange, or None for no limit
+    timeout = None
+    # metrics.Metrics instance recording timings and counters, or None to record nothing
+    metrics = None
+    # retry.RetryPolicy of this connection, created on first use; see policy
+    retry_policy = None
+    # retry.CircuitBreaker, or None for no breaker
+    breaker = None
+    # True while the breaker is also used by other open connections, so closing this one leaves it running
+    shared_breaker = False
+    termination = '\n'
+
+    @property
+    def policy(self):
+        '''
+        retry.RetryPolicy applied to every exchange. Each connection has its own, so
+        changing one device's policy never affects another.
+        '''
+        if self.retry_policy is None:
+            self.retry_policy = retry.RetryPolicy()
+        return self.retry_policy
+
+    @policy.setter
+    def policy(self,policy):
+        self.retry_policy = policy
+
+    def build(self,message):
+        '''
+        Build a message string with correct termination. Messages that are already
+        terminated are left as they are.
+        '''
+        if isinstance(message,bytes):
+            message = message.decode()
+        if message.endswith(self.termination):
+            return message
+        return message + self.termination
+
+    @property
+    def metrics_label(self):
+        '''
+        Label of this connection in its metrics: the bus, unless the transport keeps them per device.
+        '''
+        return str(self.bus)
+
+    def attempt(self,message,function,retry=True):
+        '''
+        Run one exchange under this connection's policy and breaker, see retry.RetryPolicy.run.
+
+        args:
+
+            - message: message exchanged, to pick the timeout and label errors
+
+            - function: callable(timeout) doing one attempt, raising on failure
+
+            - retry: bool, False for exchanges that must not be repeated
+        '''
+        return self.policy.run(self,message,function,retry)
+
+    def write(self,message):
+
+        raise NotImplementedError('{:s} cannot write.'.format(type(self).__name__))
+
+    def read(self):
+
+        raise NotImplementedError('{:s} cannot read.'.format(type(self).__name__))
+
+    def query(self,message):
+        '''
+        Combined write-read command.
+        '''
+        self.write(message)
+        return self.read()
+
+    def query_many(self,messages):
+        '''
+        Send a batch of queries and return their replies, in order. Sent one after
+        another by default; transports that can pipeline override this.
+
+        args:
+
+            - messages: list of built query messages
+
+        return:
+
+            - replies: list of strings
+        '''
+        return [self.query(message) for message in messages]
+
+    def close(self):
+
+        pass
+
+    async def run_async(self,function,*args):
+        '''
+        Run a blocking call of this transport in a worker thread. Callers sharing the
+        transport must serialize their calls, as Device does with its bus lock.
+        '''
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None,functools.partial(function,*args))
+
+    async def awrite(self,message):
+
+        return await self.run_async(self.write,message)
+
+    async def aread(self):
+
+        return await self.run_async(self.read)
+
+    async def aquery(self,message):
+
+        return await self.run_async(self.query,message)
+
+    async def aquery_many(self,messages):
+
+        return await self.run_async(self.query_many,messages)
+
+# Protocol name: transport class, or 'module:Class' (relative to this package if it starts with '.')
+protocols = {'GPIB':'.visa_module:GPIB',
+             'Serial_VISA':'.visa_module:Serial',
+             'RS232':'.serial_module:RS232',
+             'Sim':'.sim_module:Sim',
+             'TCP':'.socket_module:TCP'}
+
+_lock = threading.Lock()
+_entry_points_loaded = False
+
+def register(name,transport):
+    '''
+    Make a transport available under a Protocol name, replacing any existing one.
+
+    args:
+
+        - name: string, value of the 'Protocol' communication argument
+
+        - transport: transport class, or 'module:Class' string to import on first use
+    '''
+    with _lock:
+        protocols[name] = transport
+
+def load_entry_points():
+    '''
+    Register transports advertised by installed packages, without overriding
+    protocols already registered. Runs once.
+    '''
+    global _entry_points_loaded
+    with _lock:
+        if _entry_points_loaded:
+            return
+        _entry_points_loaded = True
+        from importlib import metadata
+        found = metadata.entry_points()
+        if hasattr(found,'select'):
+            found = found.select(group=entry_point_group)
+        else:
+            # before Python 3.10, a dictionary of group:entry points
+            found = found.get(entry_point_group,[])
+        for entry_point in found:
+            protocols.setdefault(entry_point.name,entry_point.value)
+
+def resolve(reference):
+    '''
+    Import a 'module:Class' string.
+    '''
+    module,_,name = reference.partition(':')
+    package = __package__ if module.startswith('.') else None
+    return getattr(importlib.import_module(module,package),name)
+
+def get(name):
+    '''
+    Resolve a Protocol name to its transport class, importing it on first use.
+
+    return:
+
+        - transport class, or None if no transport is registered under the name
+    '''
+    if name not in protocols:
+        load_entry_points()
+        if name not in protocols:
+            return None
+    transport = protocols[name]
+    if isinstance(transport,str):
+        transport = resolve(transport)
+        with _lock:
+            protocols[name] = transport
+    return transport
+
+def available():
+    '''
+    Names of all registered protocols, including those from entry points.
+    '''
+    load_entry_points()
+    return sorted(protocols)
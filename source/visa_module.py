@@ -5,22 +5,195 @@ Created on Mon Jun 29 17:16:35 2020
 
 @author: ryanday
 """
+import threading
+import time
 import pyvisa as visa
+from . import errors
+from . import metrics as metrics_module
+from . import transport
 
-class GPIB:
+_resource_managers = {}
+_resource_managers_lock = threading.Lock()
+
+def get_resource_manager(backend='@py'):
+    '''Get the shared ResourceManager for a pyvisa backend, starting it on first use.
+    Each call must be paired with release_resource_manager().
+
+    args:
+
+    - backend: string, pyvisa backend identifier
+
+    return:
+
+    - ResourceManager: pyvisa ResourceManager instance
+    '''
+    with _resource_managers_lock:
+        if backend not in _resource_managers:
+            _resource_managers[backend] = [visa.ResourceManager(backend), 0]
+        entry = _resource_managers[backend]
+        entry[1] += 1
+        return entry[0]
+
+def release_resource_manager(backend='@py'):
+    '''Drop one user of a shared ResourceManager. The last user to release it closes it.
+
+    args:
+
+    - backend: string, pyvisa backend identifier
+    '''
+    with _resource_managers_lock:
+        entry = _resource_managers.get(backend)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _resource_managers[backend]
+    entry[0].close()
+
+def register_resource_manager(backend,manager):
+    '''Use an existing ResourceManager, or a stand-in with the same interface, for a backend
+    name. Like prewarmed managers, it holds one reference, released with release_resource_manager().
+
+    args:
+
+    - backend: string, backend name given as "Backend" in the communication arguments
+
+    - manager: ResourceManager instance
+    '''
+    with _resource_managers_lock:
+        if backend in _resource_managers:
+            raise ValueError('A ResourceManager for backend {:s} is already in use.'.format(backend))
+        _resource_managers[backend] = [manager, 1]
+
+def prewarm(backends=('@py',)):
+    '''Start ResourceManagers ahead of time so that the first connection does not pay for
+    backend startup. Prewarmed managers hold one reference each, released with release_resource_manager().
+
+    args:
+
+    - backends: iterable of strings, pyvisa backend identifiers
+    '''
+    for backend in backends:
+        get_resource_manager(backend)
+
+def list_open_resources(backend=None):
+    '''List resources currently opened through the shared ResourceManagers.
+
+    args:
+
+    - backend: string, restrict to one backend. All backends are listed if None.
+
+    return:
+
+    - resources: dictionary, backend:list of resource names
+    '''
+    with _resource_managers_lock:
+        managers = {key:entry[0] for key,entry in _resource_managers.items() if backend is None or key == backend}
+    return {key:[resource.resource_name for resource in manager.list_opened_resources()] for key,manager in managers.items()}
+
+def record(connection,message,start,reply):
+    '''Record one exchange in the connection's metrics: duration, bytes each way and empty replies.'''
+    connection.metrics.observe(connection.metrics_label,metrics_module.command_label(message),time.perf_counter() - start)
+    connection.metrics.count('bytes_out',connection.metrics_label,len(message))
+    if reply is None:
+        return
+    connection.metrics.count('bytes_in',connection.metrics_label,len(reply))
+    if not reply:
+        connection.metrics.count('empty_replies',connection.metrics_label)
+
+def bus_key(address):
+    '''Bus a VISA resource sits on: the board for GPIB, where devices share the wire; otherwise
+    the resource itself, since TCPIP, USB and serial instruments each have a link of their own.
+
+    args:
+
+    - address: string, VISA resource name
+
+    return:
+
+    - bus: string
+    '''
+    if address.upper().startswith('GPIB'):
+        return address.split('::')[0]
+    return address
+
+def wrap_error(connection,message,error):
+    '''Structured error for an exception raised by pyvisa: DeviceTimeout for a VISA timeout, TransportError otherwise.'''
+    header = metrics_module.command_label(message)
+    if isinstance(error,visa.errors.VisaIOError) and error.error_code == visa.constants.StatusCode.error_timeout:
+        wrapped = errors.DeviceTimeout('No reply on {:s}.'.format(connection.address),connection.bus,header)
+    else:
+        wrapped = errors.TransportError('{:s} failed on {:s}: {:s}'.format(header,connection.address,str(error)),connection.bus,header)
+    wrapped.__cause__ = error
+    return wrapped
+
+def exchange(connection,message,call,retry=True):
+    '''Run call() on the VISA resource under the connection's retry policy, with the resource
+    timeout set for the command. Errors are raised as errors.InstrumentError, and an empty reply
+    counts as a timeout.
+
+    args:
+
+    - connection: GPIB or Serial instance
+
+    - message: string, message exchanged, to pick the timeout and label errors
+
+    - call: callable() returning the reply string
+
+    - retry: bool, False for exchanges that must not be repeated, such as a bare read
+
+    return:
+
+    - reply: string, stripped
+    '''
+    resource = connection.connection
+
+    def attempt(timeout):
+        default = resource.timeout
+        if timeout is not None and 1000*timeout != default:
+            resource.timeout = 1000*timeout
+        try:
+            reply = call().strip()
+        except Exception as error:
+            raise wrap_error(connection,message,error)
+        finally:
+            resource.timeout = default
+        if not reply:
+            raise errors.DeviceTimeout('Empty reply on {:s}.'.format(connection.address),connection.bus,metrics_module.command_label(message))
+        return reply
+
+    return connection.attempt(message,attempt,retry)
+
+class GPIB(transport.Transport):
 
     def __init__(self,communication_args):
         '''Instantiate the GPIB connection. We use the pyvisa package for communication via GPIB.
 
         args:
 
-        - communication_args: dictionary
+        - communication_args: dictionary. Optional "Backend" selects the pyvisa backend (default '@py');
+        all connections on the same backend share one ResourceManager.
 
         '''
-        self.ResourceManager = visa.ResourceManager('@py')
+        self.backend = communication_args.get('Backend','@py')
+        self.ResourceManager = get_resource_manager(self.backend)
         self.address = communication_args['Address']
+        self.bus = bus_key(self.address)
         self.termination = ''
-        self.connection = self.connect()
+        self.block_trailer = communication_args.get('BlockTrailer',1)
+        self.timeout = communication_args.get('Timeout',2.0)
+        try:
+            self.connection = self.connect()
+        except:
+            release_resource_manager(self.backend)
+            raise
+        self.connection.timeout = 1000*self.timeout
+
+    @property
+    def metrics_label(self):
+        '''Metrics are kept per resource, since several devices share a GPIB board.'''
+        return self.address
 
     def connect(self):
         '''Establish connection with device at designated location.
@@ -34,10 +207,15 @@ class GPIB:
 
     def close(self):
         '''Close and disconnection the communication line with device.
+        Closing again does nothing, so the ResourceManager is released only once.
         '''
 
+        if self.connection is None:
+            return
         self.connection.before_close()
         self.connection.close()
+        self.connection = None
+        release_resource_manager(self.backend)
 
 
     def build(self,message):
@@ -49,8 +227,9 @@ class GPIB:
         return message_string
 
     def query(self,query):
-        '''Combined write-read command. If device fails to return anything (e.g. no connection),
-        this returns an empty string
+        '''Combined write-read command. Failed attempts are repeated as the connection's retry
+        policy allows; if the device still fails to reply (e.g. no connection), an errors.InstrumentError
+        is raised, or an empty string returned if the policy has raise_errors=False.
 
         args:
 
@@ -60,11 +239,38 @@ class GPIB:
 
         - message: string, response from device
         '''
+        start = time.perf_counter()
+        reply = ''
         try:
-            message = self.connection.query(query).strip()
-        except:
-            message = ''
-        return message
+            reply = exchange(self,query,lambda: self.connection.query(query))
+            return reply
+        finally:
+            if self.metrics is not None:
+                record(self,query,start,reply)
+
+    def query_binary(self,query,dtype='f4',endianness='>',out=None):
+        '''Query a binary block (IEEE 488.2 '#<n><length>' format), e.g. a waveform or data buffer.
+        The payload is read straight into a buffer and returned as a typed array view of it; errors
+        are raised rather than turned into an empty reply. Requires numpy.
+
+        args:
+
+        - query: string, question to transmit to device
+
+        - dtype: NumPy dtype of the payload elements
+
+        - endianness: '>' (IEEE 488.2 normal byte order) or '<', or None to use dtype as given
+
+        - out: bytearray or NumPy array to read into, reused between calls to avoid allocation
+
+        return:
+
+        - values: NumPy array view of the payload
+        '''
+        from . import binary_block
+
+        self.connection.write(query)
+        return binary_block.read_block(self.connection.read_bytes,None,dtype,endianness,out,trailer=self.block_trailer)
 
     def write(self, message):
         '''Write message to device.
@@ -72,35 +278,58 @@ class GPIB:
 
            - message: string, message for device.'''
 
+        start = time.perf_counter()
         self.connection.write(message)
+        if self.metrics is not None:
+            record(self,message,start,None)
 
     def read(self):
-        '''Read data off the bus. Return empty string if read() raises an error (e.g. no device)
+        '''Read data off the bus, once. Errors (e.g. no device) are raised as errors.InstrumentError,
+        or give an empty string if the retry policy has raise_errors=False.
 
         return:
 
            - message: string, data from device.
         '''
+        message = ''
         try:
-           message = self.connection.read().strip()
-        except:
-           message = ''
-        return message
+            message = exchange(self,'read',self.connection.read,retry=False)
+            return message
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('bytes_in',self.metrics_label,len(message))
+                if not message:
+                    self.metrics.count('empty_replies',self.metrics_label)
 
-class Serial:
+class Serial(transport.Transport):
 
     def __init__(self,communication_args):
         '''Instantiate the Serial connection. We use the pyvisa package for communication via a virtual comm port (ie not directly accessing the comm port). Main difference from GPIB module is the addition of a terminator. In the future, I could think about combining these two kinds of
 
         args:
 
-        - communication_args: dictionary
+        - communication_args: dictionary. Optional "Backend" selects the pyvisa backend (default '@py');
+        all connections on the same backend share one ResourceManager.
 
         '''
-        self.ResourceManager = visa.ResourceManager('@py')
+        self.backend = communication_args.get('Backend','@py')
+        self.ResourceManager = get_resource_manager(self.backend)
         self.address = communication_args['Address']
+        self.bus = bus_key(self.address)
         self.termination = communication_args['Terminator']
-        self.connection = self.connect()
+        self.block_trailer = communication_args.get('BlockTrailer',len(self.termination))
+        self.timeout = communication_args.get('Timeout',2.0)
+        try:
+            self.connection = self.connect()
+        except:
+            release_resource_manager(self.backend)
+            raise
+        self.connection.timeout = 1000*self.timeout
+
+    @property
+    def metrics_label(self):
+        '''Metrics are kept per resource: the VISA address of the serial port.'''
+        return self.address
 
     def connect(self):
         '''Establish connection with device at designated location.
@@ -109,29 +338,37 @@ class Serial:
 
         - connection: communication connection '''
 
-        print(self.address)
         connection = self.ResourceManager.open_resource(self.address)
         return connection
 
     def close(self):
         '''Close and disconnection the communication line with device.
+        Closing again does nothing, so the ResourceManager is released only once.
         '''
 
+        if self.connection is None:
+            return
         self.connection.before_close()
         self.connection.close()
+        self.connection = None
+        release_resource_manager(self.backend)
 
 
     def build(self,message):
-        '''Buile a message string with correct termination
+        '''Buile a message string with correct termination. Messages that are already
+        terminated are left as they are, so build() can safely be applied twice.
         '''
 
+        if message.endswith(self.termination):
+            return message
         message_string = message + self.termination
 
         return message_string
 
     def query(self,query):
-        '''Combined write-read command. If device fails to return anything (e.g. no connection),
-        this returns an empty string
+        '''Combined write-read command. Failed attempts are repeated as the connection's retry
+        policy allows; if the device still fails to reply (e.g. no connection), an errors.InstrumentError
+        is raised, or an empty string returned if the policy has raise_errors=False.
 
         args:
 
@@ -141,11 +378,39 @@ class Serial:
 
         - message: string, response from device
         '''
+        message = self.build(query)
+        start = time.perf_counter()
+        reply = ''
         try:
-            message = self.connection.query(self.build(query)).strip()
-        except:
-            message = ''
-        return message
+            reply = exchange(self,message,lambda: self.connection.query(message))
+            return reply
+        finally:
+            if self.metrics is not None:
+                record(self,message,start,reply)
+
+    def query_binary(self,query,dtype='f4',endianness='>',out=None):
+        '''Query a binary block (IEEE 488.2 '#<n><length>' format), e.g. a waveform or data buffer.
+        The payload is read straight into a buffer and returned as a typed array view of it; errors
+        are raised rather than turned into an empty reply. Requires numpy.
+
+        args:
+
+        - query: string, question to transmit to device
+
+        - dtype: NumPy dtype of the payload elements
+
+        - endianness: '>' (IEEE 488.2 normal byte order) or '<', or None to use dtype as given
+
+        - out: bytearray or NumPy array to read into, reused between calls to avoid allocation
+
+        return:
+
+        - values: NumPy array view of the payload
+        '''
+        from . import binary_block
+
+        self.connection.write(self.build(query))
+        return binary_block.read_block(self.connection.read_bytes,None,dtype,endianness,out,trailer=self.block_trailer)
 
     def write(self, message):
         '''Write message to device.
@@ -153,17 +418,26 @@ class Serial:
 
            - message: string, message for device.'''
 
-        self.connection.write(self.build(message))
+        message = self.build(message)
+        start = time.perf_counter()
+        self.connection.write(message)
+        if self.metrics is not None:
+            record(self,message,start,None)
 
     def read(self):
-        '''Read data off the bus. Return empty string if read() raises an error (e.g. no device)
+        '''Read data off the bus, once. Errors (e.g. no device) are raised as errors.InstrumentError,
+        or give an empty string if the retry policy has raise_errors=False.
 
         return:
 
            - message: string, data from device.
         '''
+        message = ''
         try:
-           message = self.connection.read().strip()
-        except:
-           message = ''
-        return message
+            message = exchange(self,'read',self.connection.read,retry=False)
+            return message
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('bytes_in',self.metrics_label,len(message))
+                if not message:
+                    self.metrics.count('empty_replies',self.metrics_label)
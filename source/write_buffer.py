@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Write coalescing for setpoint commands.
+
+Feedback loops tend to send the same setpoint, or one that is superseded a few
+milliseconds later, over and over. With a WriteBuffer on a Device, templated
+setpoint commands (those taking an argument) are held back for a short window.
+Only the latest value per command and channel is kept, and a value equal to
+the last one sent is dropped outright. Anything pending goes out when the window
+closes, on flush(), or before any query or unbuffered write, so reads never see
+a stale setpoint.
+'''
+
+import threading
+
+class WriteBuffer:
+
+    def __init__(self,device,window=0.05):
+        '''
+        args:
+
+            - device: Device instance the writes are for
+
+            - window: float, seconds a pending setpoint may wait before it is sent. 0 holds
+            writes until the next flush(), query or unbuffered write.
+        '''
+        self.device = device
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.sent = {}
+        self.timer = None
+        self.stats = {'Submitted':0,'Dropped':0,'Superseded':0,'Sent':0}
+
+    def submit(self,name,channel,value):
+        '''
+        Queue a setpoint command.
+
+        args:
+
+            - name: string, command name in the device's CommandTable
+
+            - channel: int, channel number, or None
+
+            - value: command argument(s)
+        '''
+        message = self.device.Templates[name].format(channel,value)
+        key = (name,channel)
+        with self.lock:
+            self.stats['Submitted'] += 1
+            if self.sent.get(key) == message:
+                # device already holds this value; cancel any different value still pending
+                if self.pending.pop(key,None) is not None:
+                    self.stats['Superseded'] += 1
+                self.stats['Dropped'] += 1
+                return
+            if key in self.pending:
+                self.stats['Superseded'] += 1
+            self.pending[key] = message
+            if self.window and self.timer is None:
+                self.timer = threading.Timer(self.window,self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        '''
+        Send every pending setpoint now. Cheap when nothing is pending.
+        '''
+        if not self.pending:
+            return
+        with self.device.lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            for key,message in pending.items():
+                self.device.send(self.device.connection.build(message))
+                self.sent[key] = message
+                self.stats['Sent'] += 1
+
+    def forget(self):
+        '''
+        Clear the record of values sent, e.g. after a reset or an unbuffered write
+        whose effect is unknown, so that the next setpoint is always sent.
+        '''
+        with self.lock:
+            self.sent.clear()
+
+    def close(self):
+        '''
+        Flush, and stop the window timer.
+        '''
+        self.flush()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None